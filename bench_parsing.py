@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+#
+# bench_parsing.py
+#
+# Micro-benchmark for the cached subject parsing & date conversion used for every downloaded email.
+# Compares cached calls (how dupReport runs) with uncached ones, using a mailbox-like mix where
+# a few backup jobs send many reports.
+#
+# Usage: bench_parsing.py [-n MESSAGES] [-j JOBS]
+#
+
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import dupReport
+
+subjectArgs = ('^Duplicati Backup report for', '\\w*', '\\w*', '-')
+
+def main():
+    argParser = argparse.ArgumentParser(description='Benchmark dupReport subject parsing & date conversion.')
+    argParser.add_argument('-n', '--messages', help='Number of messages in the simulated mailbox. (Default: 10000)', type=int, default=10000)
+    argParser.add_argument('-j', '--jobs', help='Number of distinct backup jobs. (Default: 20)', type=int, default=20)
+    args = argParser.parse_args()
+    dupReport.logLevel = 0
+
+    # Each job reports once a day. BeginTime & EndTime strings repeat across the jobs that run at the same time
+    subjects = ['Duplicati Backup report for src{}-dst{}'.format(i % args.jobs, i % 3) for i in range(args.messages)]
+    dates = ['{}/{}/2018 {}:05:01 {}'.format((i // args.jobs) % 12 + 1, (i // args.jobs) % 28 + 1, i % 12 + 1, 'AM' if i % 2 else 'PM') \
+        for i in range(args.messages)]
+
+    def run_subjects(parse):
+        for subject in subjects:
+            parse(subject, *subjectArgs)
+
+    def run_dates(convert):
+        for dtString in dates:
+            convert(dtString, 'MDY')
+
+    tests = [
+        ('parse_subject()     uncached', lambda: run_subjects(dupReport.parse_subject.__wrapped__)),
+        ('parse_subject()     cached', lambda: run_subjects(dupReport.parse_subject)),
+        ('convert_date_time() uncached', lambda: run_dates(dupReport.convert_date_time.__wrapped__)),
+        ('convert_date_time() cached', lambda: run_dates(dupReport.convert_date_time)),
+        ]
+
+    def clear_caches():    # Every repeat starts cold, like a new dupReport run
+        dupReport.parse_subject.cache_clear()
+        dupReport.convert_date_time.cache_clear()
+
+    for label, func in tests:
+        best = min(timeit.repeat(func, setup=clear_caches, number=1, repeat=5))
+        sys.stdout.write('{:30} {:8.2f} us/message\n'.format(label, best / args.messages * 1000000))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
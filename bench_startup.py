@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+#
+# bench_startup.py
+#
+# Measure dupReport start-up cost with 'python -X importtime' for version (-V), collect-only (-c)
+# and report-only (-t) runs, and check that each mode only loads the modules it needs.
+#
+# Runs against a scratch .rc file & database in a temporary directory. Mail servers point at a closed
+# local port, so collect & report runs fail fast right after their imports.
+#
+# Usage: bench_startup.py [-n RUNS] [--limit MS]
+# Exits with 1 if a mode loads a module it shouldn't, or if --limit is given and a mode's median import
+# time is above it.
+#
+
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+import statistics
+import configparser
+
+scriptPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dupReport.py')
+
+# Modules each mode must not load. Transport, MIME, export & server modules are imported only by the code that uses them
+forbidden = {
+    '-V': ('imaplib', 'poplib', 'smtplib', 'email.mime', 'email.parser', 'json', 'csv', 'gzip', 'http.server', 'numpy'),
+    '-c': ('smtplib', 'email.mime', 'json', 'csv', 'gzip', 'http.server', 'numpy'),
+    '-t': ('imaplib', 'poplib', 'email.parser', 'json', 'csv', 'gzip', 'http.server'),
+    }
+
+# Create scratch .rc file & database. Servers point at a closed port so nothing leaves the machine
+def make_config(workDir):
+    base = [sys.executable, scriptPath, '-r', workDir, '-d', workDir, '-l', workDir]
+    subprocess.run(base + ['-i'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)    # Creates .rc file
+
+    rcPath = os.path.join(workDir, 'dupReport.rc')
+    rcConfig = configparser.ConfigParser(interpolation=None)
+    rcConfig.read(rcPath)
+    for section in ('incoming', 'outgoing'):
+        rcConfig.set(section, 'server', '127.0.0.1')
+        rcConfig.set(section, 'port', '1')
+        rcConfig.set(section, 'encryption', 'none')
+    rcConfig.set('incoming', 'transport', 'imap')
+    rcConfig.set('outgoing', 'retries', '0')
+    rcConfig.set('main', 'verbose', '0')
+    with open(rcPath, 'w') as rcFile:
+        rcConfig.write(rcFile)
+
+    subprocess.run(base + ['-i'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)    # Creates database
+    return base
+
+# Run dupReport once with -X importtime
+# Returns (total import time in microseconds, set of imported module names)
+def import_times(base, mode):
+    cmd = [sys.executable, '-X', 'importtime'] + base[1:] + [mode]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+
+    total = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if (len(fields) != 3) or (not fields[1].strip().isdigit()):    # Header line
+            continue
+        name = fields[2].rstrip()
+        modules.add(name.strip())
+        if not name[1:].startswith(' '):    # Top-level import. Nested ones are indented & already counted in its total
+            total += int(fields[1])
+    return total, modules
+
+def main():
+    argParser = argparse.ArgumentParser(description='Benchmark dupReport start-up imports.')
+    argParser.add_argument('-n', '--runs', help='Runs per mode. Median is reported. (Default: 5)', type=int, default=5)
+    argParser.add_argument('--limit', help='Fail if a mode\'s median import time is above this many milliseconds.', type=float)
+    args = argParser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workDir:
+        base = make_config(workDir)
+        for mode in ('-V', '-c', '-t'):
+            totals = []
+            modules = set()
+            for run in range(args.runs):
+                total, runModules = import_times(base, mode)
+                totals.append(total)
+                modules |= runModules
+            median = statistics.median(totals) / 1000.0
+            sys.stdout.write('{}  median import time {:8.1f} ms  ({} modules)\n'.format(mode, median, len(modules)))
+
+            wrong = sorted(name for name in modules for bad in forbidden[mode] if (name == bad) or name.startswith(bad + '.'))
+            if wrong:
+                sys.stdout.write('    FAIL: {} should not import {}\n'.format(mode, ', '.join(wrong)))
+                failed = True
+            if (args.limit is not None) and (median > args.limit):
+                sys.stdout.write('    FAIL: {} import time above {} ms limit\n'.format(mode, args.limit))
+                failed = True
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,22 +8,18 @@
 
 import os
 import sys
-import imaplib
-import getpass
-import email
 import datetime
 import sqlite3
 import re
 import time
+import functools
 import argparse
-import poplib
 import os.path
-import smtplib
 import configparser
 from configparser import SafeConfigParser 
-import email
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+
+# Transport (imaplib, poplib, smtplib), email parsing/MIME and export modules are imported
+# inside the functions that use them. A collect-only or report-only run then only pays for what it uses.
 
 # Define version info
 version=[2,0,3]     # Program Version
@@ -31,27 +27,84 @@ dbversion=[1,0,0]   # Required DB version
 copyright='2017'
 
 # Define global variables
-options={}        # Parsed and read options from command line & .rc file
+options={}        # Parsed and read options from command line & .rc file (command line program only. DupReport objects keep their own)
 logFile = None    # Handle for log file
-emailText=[]      # List of email text components
-emailFormat=[]    # Corresponding list of emial components print formats
+logLevel = 1      # Logging level. See write_log_entry()
 dbName='dupReport.db'
 logName='dupReport.log'
 rcName='dupReport.rc'
 
+# Configuration or setup problem that stops dupReport from running
+# Raised to library callers. The command line program reports it & exits (see main())
+class DupReportError(Exception):
+    pass
+
 # Execute a Sqlite command and manage exceptions
-def exec_sqlite(conn, stmt):
+# Pass values as params (with '?' placeholders in stmt) so Sqlite can reuse the prepared statement from its cache
+# Errors are logged & raised as sqlite3.Error. Can't continue with DB error, so the command line program exits (see main())
+def exec_sqlite(conn, stmt, params=()):
 
     curs = conn.cursor()
 
     try:
-        curs.execute(stmt)
+        curs.execute(stmt, params)
     except sqlite3.Error as err:
-        sys.stderr.write('SQLite error: {}\n'.format(err.args[0]))  # Special case here. Write to stderr regardless of logging level
-        sys.exit(1) # Abort program. Can't continue with DB error
+        write_log_entry(1, 'SQLite error: {} in [{}]'.format(err.args[0], stmt))
+        raise
     return curs
 
 
+# Open database connection
+# WAL journal lets report reads run while the collector is writing, and the busy timeout makes
+# writers wait for each other instead of failing with 'database is locked'
+def open_database(opts):
+    conn = sqlite3.connect(opts['dbpath'], timeout=opts['busytimeout'])
+    exec_sqlite(conn, 'PRAGMA journal_mode=WAL')
+    return conn
+
+# Get run lock so overlapping runs (e.g., from cron) don't do the same job at the same time
+# Uses an advisory lock on <dbpath>.<name>.lock. Lock is released by release_run_lock() or when the program exits.
+# lockpolicy=wait - wait up to locktimeout seconds for the lock
+# lockpolicy=skip - give up right away if someone else has it
+# Returns open lock file if lock acquired, None if not
+def acquire_run_lock(opts, name):
+    lockPath = '{}.{}.lock'.format(opts['dbpath'], name)
+    write_log_entry(1, 'acquire_run_lock({})'.format(lockPath))
+
+    lockFile = open(lockPath, 'a')
+    if opts['lockpolicy'] == 'skip':
+        waitUntil = time.time()
+    else:
+        waitUntil = time.time() + opts['locktimeout']
+
+    while True:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                lockFile.seek(0)
+                msvcrt.locking(lockFile.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            write_log_entry(2, 'Lock {} acquired'.format(lockPath))
+            return lockFile
+        except OSError:    # Somebody else has it
+            if time.time() >= waitUntil:
+                write_log_entry(1, 'Another dupReport {} run is in progress (lock {}). Skipping.'.format(name, lockPath))
+                lockFile.close()
+                return None
+            time.sleep(1)
+
+# Release run lock acquired by acquire_run_lock()
+def release_run_lock(lockFile):
+    write_log_entry(2, 'release_run_lock({})'.format(lockFile.name))
+    if os.name == 'nt':
+        import msvcrt
+        lockFile.seek(0)
+        msvcrt.locking(lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+    lockFile.close()    # Closing the file releases a flock() lock
+
+
 # Initialize database to empty, default tables
 def db_initialize(conn):
 
@@ -61,6 +114,8 @@ def db_initialize(conn):
     exec_sqlite(conn,"drop table if exists backupsets")
     exec_sqlite(conn,"drop index if exists emailindx")
     exec_sqlite(conn,"drop index if exists srcdestindx")
+    exec_sqlite(conn,"drop index if exists srcdestdateindx")
+    exec_sqlite(conn,"drop table if exists reportfragments")
  
     # version table holds current database version.
     # Has no real purpose now, but will be useful if need to change database formats later
@@ -68,28 +123,124 @@ def db_initialize(conn):
     exec_sqlite(conn,"insert into version(desc, major, minor, subminor) values (\'database\',{},{},{})".format(dbversion[0], dbversion[1],dbversion[2]))
 
     # emails table holds information about all emails received
-    sqlStmt = "create table emails (messageId varchar(50), sourceComp varchar(50), destComp varchar(50), \
+    create_emails_table(conn, 'main')
+
+    # backup sets contains information on all source-destination pairs in the backups
+    exec_sqlite(conn,"create table backupsets (source varchar(20), destination varchar(20), lastFileCount integer, lastFileSize integer, \
+        lastDate varchar(50), lastTime varchar(50))")
+
+    db_update_schema(conn)
+
+# Create tables & indexes added after database version 1.0.0, if they aren't there yet
+# They don't change what older versions of the program store, so existing databases get them when opened
+def db_update_schema(conn):
+    create_emails_table(conn, 'main')
+
+    # reportfragments keeps rendered report lines for pairs with no new activity. See create_summary_report()
+    exec_sqlite(conn,"create table if not exists reportfragments (source varchar(20), destination varchar(20), lastDate varchar(50), \
+        lastTime varchar(50), reportDate varchar(20), text text, html text, primary key (source, destination))")
+
+    conn.commit()
+
+# Create emails table & indexes in the given database ('main' or name of an attached archive database)
+def create_emails_table(conn, dbSchema):
+    sqlStmt = "create table if not exists {}.emails (messageId varchar(50), sourceComp varchar(50), destComp varchar(50), \
         emailDate varchar(50), emailTime varchar(50), deletedFiles int, deletedFolders int, modifiedFiles int, \
         examinedFiles int, openedFiles int, addedFiles int, sizeOfModifiedFiles int, sizeOfAddedFiles int, sizeOfExaminedFiles int, \
         sizeOfOpenedFiles int, notProcessedFiles int, addedFolders int, tooLargeFiles int, filesWithError int, \
         modifiedFolders int, modifiedSymlinks int, addedSymlinks int, deletedSymlinks int, partialBackup varchar(30), \
         dryRun varchar(30), mainOperation varchar(30), parsedResult varchar(30), verboseOutput varchar(30), \
         verboseErrors varchar(30), endDate varchar(30), endTime varchar(30), beginDate varchar(30), beginTime varchar(30), \
-        duration varchar(30), messages varchar(255), warnings varchar(255), errors varchar(255), failedMsg varchar(100))"
+        duration varchar(30), messages varchar(255), warnings varchar(255), errors varchar(255), failedMsg varchar(100))".format(dbSchema)
     exec_sqlite(conn,sqlStmt)
-    exec_sqlite(conn,"create index emailindx on emails (messageId)")
-    exec_sqlite(conn,"create index srcdestindx on emails (sourceComp, destComp)")
-
-    # backup sets contains information on all source-destination pairs in the backups
-    exec_sqlite(conn,"create table backupsets (source varchar(20), destination varchar(20), lastFileCount integer, lastFileSize integer, \
-        lastDate varchar(50), lastTime varchar(50))")
-
-    conn.commit()
+    exec_sqlite(conn,"create index if not exists {}.emailindx on emails (messageId)".format(dbSchema))
+    exec_sqlite(conn,"create index if not exists {}.srcdestindx on emails (sourceComp, destComp)".format(dbSchema))
+    # Lets the report & history queries seek straight to a pair's newest emails instead of reading its whole history
+    exec_sqlite(conn,"create index if not exists {}.srcdestdateindx on emails (sourceComp, destComp, endDate, endTime)".format(dbSchema))
+
+# Archive databases
+# Closed years of the emails table are moved to dupReport_<year>.db (next to dupReport.db) by --rollover.
+# The main database then only holds the current period, keeping it & its indexes small.
+# Queries that need older history attach the archive files they need, a few at a time (see history_table_batches()).
+
+# Path to archive database for a year
+def archive_path(opts, year):
+    base, ext = os.path.splitext(opts['dbpath'])
+    return '{}_{}{}'.format(base, year, ext)
+
+# List of years that have archive databases, oldest first
+def archive_years(opts):
+    base, ext = os.path.splitext(opts['dbpath'])
+    pattern = re.compile(r'^{}_(\d{{4}}){}$'.format(re.escape(os.path.basename(base)), re.escape(ext)))
+    dirName = os.path.dirname(opts['dbpath']) or '.'
+    return sorted(int(match.group(1)) for match in (pattern.match(fName) for fName in os.listdir(dirName)) if match)
+
+# Attach archive database for a year (if not already attached)
+# Returns schema name to use in queries
+def attach_archive(conn, opts, year):
+    dbSchema = 'archive{}'.format(year)
+    attached = [row[1] for row in exec_sqlite(conn, 'PRAGMA database_list').fetchall()]
+    if dbSchema not in attached:
+        write_log_entry(2, 'Attaching archive database {} as {}'.format(archive_path(opts, year), dbSchema))
+        exec_sqlite(conn, 'ATTACH DATABASE ? AS {}'.format(dbSchema), (archive_path(opts, year),))
+    return dbSchema
+
+# Detach archive database attached by attach_archive()
+def detach_archive(conn, dbSchema):
+    write_log_entry(2, 'Detaching archive database {}'.format(dbSchema))
+    exec_sqlite(conn, 'DETACH DATABASE {}'.format(dbSchema))
+
+# Get list of archive years covering date range fromDate - toDate (YYYY/MM/DD, None = open ended), oldest first
+def history_years(opts, fromDate=None, toDate=None):
+    years = [year for year in archive_years(opts) if ((fromDate is None) or (fromDate[:4] <= str(year))) and \
+        ((toDate is None) or (str(year) <= toDate[:4]))]
+    write_log_entry(2, 'history_years({}, {}) = {}'.format(fromDate, toDate, years))
+    return years
+
+# Go through the emails tables of archive years (see history_years()), then the main database
+# Yields lists of up to batchSize table names to query together. Each batch of archives is attached just before it's
+# yielded and detached right after, so there are never more than batchSize attached (Sqlite's default limit is 10).
+# Archives can't be attached or detached inside a transaction, and every query on them must be finished before the next batch.
+def history_table_batches(conn, opts, years, batchSize=1):
+    for i in range(0, len(years), batchSize):
+        schemas = [attach_archive(conn, opts, year) for year in years[i:i+batchSize]]
+        try:
+            yield ['{}.emails'.format(dbSchema) for dbSchema in schemas]
+        finally:
+            for dbSchema in schemas:
+                detach_archive(conn, dbSchema)
+    yield ['main.emails']
+
+# Move emails from closed years (before the current year) into yearly archive databases
+def rollover_emails(conn, opts):
+    write_log_entry(1, 'rollover_emails()')
+
+    cutoff = '{:04d}/01/01'.format(datetime.date.today().year)
+    dbCursor = exec_sqlite(conn, 'SELECT DISTINCT substr(endDate, 1, 4) FROM emails WHERE endDate < ?', (cutoff,))
+    years = sorted(int(row[0]) for row in dbCursor.fetchall())
+    write_log_entry(2, 'Years to roll over: {}'.format(years))
+
+    for year in years:
+        dbSchema = attach_archive(conn, opts, year)
+        create_emails_table(conn, dbSchema)
+        conn.commit()
+
+        # Copy, skipping anything already archived (e.g., by an earlier rollover that was interrupted), then delete
+        yearRange = ('{:04d}/'.format(year), '{:04d}/'.format(year + 1))
+        dbCursor = exec_sqlite(conn, 'INSERT INTO {0}.emails SELECT * FROM main.emails WHERE endDate >= ? AND endDate < ? \
+            AND messageId NOT IN (SELECT messageId FROM {0}.emails)'.format(dbSchema), yearRange)
+        numRows = dbCursor.rowcount
+        exec_sqlite(conn, 'DELETE FROM main.emails WHERE endDate >= ? AND endDate < ?', yearRange)
+        conn.commit()
+        detach_archive(conn, dbSchema)
+        write_log_entry(1, 'Moved {} emails from {} to {}'.format(numRows, year, archive_path(opts, year)))
+
+    if years:
+        exec_sqlite(conn, 'VACUUM')    # Give space back & shrink the indexes
 
 # Get current database version in use and see if it matches current requirement
-def curr_db_version():
-    dbConn = sqlite3.connect(options['dbpath'])
-    dbCursor = exec_sqlite(dbConn, 'SELECT major, minor, subminor FROM version WHERE desc = \'database\'')
+def curr_db_version(conn):
+    dbCursor = exec_sqlite(conn, 'SELECT major, minor, subminor FROM version WHERE desc = \'database\'')
     maj, min, subm = dbCursor.fetchone()
 
     # Is this the latest DB version?
@@ -126,6 +277,16 @@ def rc_initialize(fname):
         ('main','dispwarnings','true', True),
         ('main','dispmessages','false', True),
         ('main','sortorder','source', True),
+        ('main','dateformat','MDY', True),
+        ('main','anomalies','false', True),
+        ('main','anomalywindow','10', True),
+        ('main','anomalythreshold','3.0', True),
+        ('main','anomalyminstddev','0.01', True),
+        ('main','anomalygrowth','50', True),
+        ('main','anomalyhistory','365', True),
+        ('main','lockpolicy','wait', True),
+        ('main','locktimeout','300', True),
+        ('main','busytimeout','30', True),
         ('incoming','transport','imap', False),
         ('incoming','server','localhost', False),
         ('incoming','port','993', False),
@@ -133,6 +294,8 @@ def rc_initialize(fname):
         ('incoming','account','someacct@hostmail.com', False),
         ('incoming','password','********', False),
         ('incoming','folder','INBOX', False),
+        ('incoming','postprocess','none', True),
+        ('incoming','archivefolder','Archive', True),
         ('outgoing','server','localhost', False),
         ('outgoing','port','587', False),
         ('outgoing','encryption','tls', False),
@@ -140,6 +303,9 @@ def rc_initialize(fname):
         ('outgoing','password','********', False),
         ('outgoing','sender','sender@hostmail.com', False),
         ('outgoing','receiver','receiver@hostmail.com', False),
+        ('outgoing','maxconnections','1', True),
+        ('outgoing','retries','3', True),
+        ('outgoing','retrydelay','5', True),
         ]
 
     rcParser = configparser.SafeConfigParser()
@@ -147,24 +313,30 @@ def rc_initialize(fname):
 
     # Flag to see if any RC parts have changed
     newRc=False
+    # Flag to see if RC file needs to be rewritten at all
+    rcChanged=False
 
     for section, option, default, canCont in rcParts:
         if rcParser.has_section(section) == False: # Whole sectionm is missing. Probably a new install.
             rcParser.add_section(section)
             newRc=True
+            rcChanged=True
         if rcParser.has_option(section, option) == False: # Option is missing. Might be able to continue if non-critical.
             rcParser.set(section, option, default)
+            rcChanged=True
             if canCont == False:
                 newRc=True
 
-    # save updated RC configuration to a file
-    with open(fname, 'w') as configfile:
-        rcParser.write(configfile)
+    # save updated RC configuration to a file. Skip the write if nothing was added
+    if rcChanged:
+        with open(fname, 'w') as configfile:
+            rcParser.write(configfile)
     return newRc
 
 
 # Store command-line options
-def parse_command_line():
+# argv = list of arguments to parse. None = use sys.argv
+def parse_command_line(argv=None):
 
     # Parse command line options with ArgParser library
     argParser = argparse.ArgumentParser(description='Process dupReport options.')
@@ -185,105 +357,168 @@ def parse_command_line():
     opGroup = argParser.add_mutually_exclusive_group()
     opGroup.add_argument("-c", "--collect", help="Collect new emails only. (Don't run report)", action="store_true")
     opGroup.add_argument("-t", "--report", help="Run summary report only. (Don't collect emails)", action="store_true")
-
-    args = argParser.parse_args()
+    opGroup.add_argument("--rollover", help="Move emails from previous years into yearly archive databases and exit.", action="store_true")
+    opGroup.add_argument("-x", "--export", help="Export emails table to file ('-' for stdout) and exit. Files ending in '.gz' are gzipped.", action="store")
+    opGroup.add_argument("--serve", help="Serve pair status as JSON on http://127.0.0.1:SERVE/ until interrupted. (Read-only, localhost only)", \
+        type=int, action="store")
+
+    argParser.add_argument("--exportformat", help="Export file format. Options are 'json' (JSON Lines) or 'csv'. (Default: json)", \
+        action="store", choices=['json','csv'], default='json')
+    argParser.add_argument("--exportsrc", help="Only export emails from this source.", action="store")
+    argParser.add_argument("--exportdest", help="Only export emails to this destination.", action="store")
+    argParser.add_argument("--exportfrom", help="Only export backups ending on or after this date (YYYY/MM/DD).", action="store")
+    argParser.add_argument("--exportto", help="Only export backups ending on or before this date (YYYY/MM/DD).", action="store")
+    argParser.add_argument("--profile", help="Profile collect & report phases. Saves pstats files next to the log file & writes top functions to log.", \
+        action="store_true")
+    argParser.add_argument("--profilemem", help="Trace memory use of mailbox processing & report creation. Writes peak memory & top allocation sites to log.", \
+        action="store_true")
+    argParser.add_argument("--profiletop", help="Number of functions/allocation sites to list in profile output. (Default: 25)", \
+        type=int, action="store", default=25)
+
+    args = argParser.parse_args(argv)
     return args
 
-# Read .rc file options
+# Read .rc file options into opts dictionary
 # Many command line options have .rc equivalents. 
 # Command line options take precedence over .rc file options
-def parse_config_file(rcPath, args):
+# Raises DupReportError if the .rc file can't be used
+def parse_config_file(rcPath, args, opts):
     
     try:
         rcConfig = SafeConfigParser()
         rv=rcConfig.read(rcPath)
     except configparser.ParsingError as err:
-        sys.stderr.write('RC file parsing error: {}\n'.format(err.args[0]))
-        sys.exit(1) # Abort program. Can't continue with RC error
+        raise DupReportError('RC file parsing error: {}'.format(err.args[0]))
 
     # Extract options from .rc file
     # Gotta be a way to optimize this. Someday...
     try:
-        options['dbpath'] = rcConfig.get('main','dbpath')
-        options['logpath'] = rcConfig.get('main','logpath')
-        options['verbose'] = rcConfig.getint('main','verbose')
-        options['logappend'] = rcConfig.getboolean('main','logappend')
-        options['sizereduce'] = rcConfig.get('main','sizereduce')
-        options['subjectregex'] = rcConfig.get('main','subjectregex')
-        options['srcregex'] = rcConfig.get('main','srcregex')
-        options['destregex'] = rcConfig.get('main','destregex')
-        options['srcdestdelimiter'] = rcConfig.get('main','srcdestdelimiter')
-        options['summarysubject'] = rcConfig.get('main','summarysubject')
-        options['border'] = rcConfig.get('main','border')
-        options['padding'] = rcConfig.get('main','padding')
-        options['dispwarnings'] = rcConfig.getboolean('main','dispwarnings')
-        options['disperrors'] = rcConfig.getboolean('main','disperrors')
-        options['dispmessages'] = rcConfig.getboolean('main','dispmessages')
-        options['sortorder'] = rcConfig.get('main','sortorder')
-
-        options['intransport'] = rcConfig.get('incoming','transport')
-        options['inserver'] = rcConfig.get('incoming','server')
-        options['inport'] = rcConfig.get('incoming','port')
-        options['inencryption'] = rcConfig.get('incoming','encryption')
-        options['inaccount'] = rcConfig.get('incoming','account')
-        options['inpassword'] = rcConfig.get('incoming','password')
-        options['infolder'] = rcConfig.get('incoming','folder')
-
-        options['outserver'] = rcConfig.get('outgoing','server')
-        options['outport'] = rcConfig.get('outgoing','port')
-        options['outencryption'] = rcConfig.get('outgoing','encryption')
-        options['outaccount'] = rcConfig.get('outgoing','account')
-        options['outpassword'] = rcConfig.get('outgoing','password')
-        options['outsender'] = rcConfig.get('outgoing','sender')
-        options['outreceiver'] = rcConfig.get('outgoing','receiver')
+        opts['dbpath'] = rcConfig.get('main','dbpath')
+        opts['logpath'] = rcConfig.get('main','logpath')
+        opts['verbose'] = rcConfig.getint('main','verbose')
+        opts['logappend'] = rcConfig.getboolean('main','logappend')
+        opts['sizereduce'] = rcConfig.get('main','sizereduce')
+        opts['subjectregex'] = rcConfig.get('main','subjectregex')
+        opts['srcregex'] = rcConfig.get('main','srcregex')
+        opts['destregex'] = rcConfig.get('main','destregex')
+        opts['srcdestdelimiter'] = rcConfig.get('main','srcdestdelimiter')
+        opts['summarysubject'] = rcConfig.get('main','summarysubject')
+        opts['border'] = rcConfig.get('main','border')
+        opts['padding'] = rcConfig.get('main','padding')
+        opts['dispwarnings'] = rcConfig.getboolean('main','dispwarnings')
+        opts['disperrors'] = rcConfig.getboolean('main','disperrors')
+        opts['dispmessages'] = rcConfig.getboolean('main','dispmessages')
+        opts['sortorder'] = rcConfig.get('main','sortorder')
+        opts['dateformat'] = rcConfig.get('main','dateformat').upper()
+        opts['anomalies'] = rcConfig.getboolean('main','anomalies')
+        opts['anomalywindow'] = rcConfig.getint('main','anomalywindow')
+        opts['anomalythreshold'] = rcConfig.getfloat('main','anomalythreshold')
+        opts['anomalyminstddev'] = rcConfig.getfloat('main','anomalyminstddev')
+        opts['anomalygrowth'] = rcConfig.getfloat('main','anomalygrowth')
+        opts['anomalyhistory'] = rcConfig.getint('main','anomalyhistory')
+        opts['lockpolicy'] = rcConfig.get('main','lockpolicy').lower()
+        opts['locktimeout'] = rcConfig.getint('main','locktimeout')
+        opts['busytimeout'] = rcConfig.getint('main','busytimeout')
+
+        opts['intransport'] = rcConfig.get('incoming','transport')
+        opts['inserver'] = rcConfig.get('incoming','server')
+        opts['inport'] = rcConfig.get('incoming','port')
+        opts['inencryption'] = rcConfig.get('incoming','encryption')
+        opts['inaccount'] = rcConfig.get('incoming','account')
+        opts['inpassword'] = rcConfig.get('incoming','password')
+        opts['infolder'] = rcConfig.get('incoming','folder')
+        opts['inpostprocess'] = rcConfig.get('incoming','postprocess').lower()
+        opts['inarchivefolder'] = rcConfig.get('incoming','archivefolder')
+
+        opts['outserver'] = rcConfig.get('outgoing','server')
+        opts['outport'] = rcConfig.get('outgoing','port')
+        opts['outencryption'] = rcConfig.get('outgoing','encryption')
+        opts['outaccount'] = rcConfig.get('outgoing','account')
+        opts['outpassword'] = rcConfig.get('outgoing','password')
+        opts['outsender'] = rcConfig.get('outgoing','sender')
+        opts['outreceiver'] = rcConfig.get('outgoing','receiver')
+        opts['outmaxconnections'] = rcConfig.getint('outgoing','maxconnections')
+        opts['outretries'] = rcConfig.getint('outgoing','retries')
+        opts['outretrydelay'] = rcConfig.getint('outgoing','retrydelay')
+
+        # Report groups. Each [report:<name>] section gets its own report with just the matching pairs
+        opts['reportgroups'] = []
+        for section in rcConfig.sections():
+            if section.startswith('report:'):
+                opts['reportgroups'].append({
+                    'name': section[len('report:'):],
+                    'srcregex': re.compile(rcConfig.get(section, 'srcregex', fallback='.*')),
+                    'destregex': re.compile(rcConfig.get(section, 'destregex', fallback='.*')),
+                    'receiver': rcConfig.get(section, 'receiver'),
+                    'subject': rcConfig.get(section, 'subject', fallback='{} - {}'.format(opts['summarysubject'], section[len('report:'):])),
+                    })
     except configparser.NoOptionError as err:
-        sys.stderr.write('RC Parse error - No Option: {}\n'.format(err.args[0]))
-        sys.exit(1) # Abort program. Can't continue with RC error
+        raise DupReportError('RC Parse error - No Option: {}'.format(err.args[0]))
     except configparser.NoSectionError as err:
-        sys.stderr.write('RC Parse error - No Section: {}\n'.format(err.args[0]))
-        sys.exit(1) # Abort program. Can't continue with RC error
+        raise DupReportError('RC Parse error - No Section: {}'.format(err.args[0]))
+
+    if opts['inpostprocess'] not in ('none', 'move', 'delete'):
+        raise DupReportError('RC Parse error - [incoming]postprocess must be none, move or delete, not {}'.format(opts['inpostprocess']))
+    if opts['lockpolicy'] not in ('wait', 'skip'):
+        raise DupReportError('RC Parse error - [main]lockpolicy must be wait or skip, not {}'.format(opts['lockpolicy']))
+    if opts['dateformat'] not in ('MDY', 'DMY', 'YMD'):
+        raise DupReportError('RC Parse error - [main]dateformat must be MDY, DMY or YMD, not {}'.format(opts['dateformat']))
 
     # Now, override with command line options
     # Database Path
     if args.dbpath != None:  #dbPath specified on command line
-        options['dbpath'] = '{}/{}'.format(args.dbpath, dbName) 
-    elif options['dbpath'] == '':  # No command line & not specified in RC file
-        options['dbpath'] = '{}/{}'.format(get_script_path(), dbName)
+        opts['dbpath'] = '{}/{}'.format(args.dbpath, dbName) 
+    elif opts['dbpath'] == '':  # No command line & not specified in RC file
+        opts['dbpath'] = '{}/{}'.format(get_script_path(), dbName)
     else:  # Path specified in rc file. Add dbname for full path
-        options['dbpath'] = '{}/{}'.format(options['dbpath'], dbName)
+        opts['dbpath'] = '{}/{}'.format(opts['dbpath'], dbName)
 
     # Log file path
     if args.logpath != None:  #logPath specified on command line
-        options['logpath'] = '{}/{}'.format(args.logpath, logName)
-    elif options['logpath'] == '':  # No command line & not specified in RC file
-        options['logpath'] = '{}/{}'.format(get_script_path(), logName)
+        opts['logpath'] = '{}/{}'.format(args.logpath, logName)
+    elif opts['logpath'] == '':  # No command line & not specified in RC file
+        opts['logpath'] = '{}/{}'.format(get_script_path(), logName)
     else:  # Path specified in rc file. Add dbname for full path
-        options['logpath'] = '{}/{}'.format(options['logpath'], logName)
+        opts['logpath'] = '{}/{}'.format(opts['logpath'], logName)
 
-    options['rcpath'] = rcPath
+    opts['rcpath'] = rcPath
 
     if args.collect == True:
-        options['collect'] = True
+        opts['collect'] = True
     if args.report == True:
-        options['report'] = True
+        opts['report'] = True
     if args.verbose != None:
-        options['verbose'] = args.verbose
+        opts['verbose'] = args.verbose
     if args.append == True:
-        options['logappend'] = True
+        opts['logappend'] = True
     if args.initdb == True:
-        options['initdb'] = True
+        opts['initdb'] = True
     if args.initdbrun == True:
-        options['initdbrun'] = True
+        opts['initdbrun'] = True
     if args.mega != None:
-        options['sizereduce'] = args.mega
+        opts['sizereduce'] = args.mega
+    if args.rollover == True:
+        opts['rollover'] = True
+    if args.serve != None:
+        opts['serve'] = args.serve
+    if args.export != None:
+        opts['export'] = args.export
+        opts['exportformat'] = args.exportformat
+        opts['exportsrc'] = args.exportsrc
+        opts['exportdest'] = args.exportdest
+        opts['exportfrom'] = args.exportfrom
+        opts['exportto'] = args.exportto
+    opts['profile'] = args.profile
+    opts['profilemem'] = args.profilemem
+    opts['profiletop'] = args.profiletop
 
     return
 
-def version_info():
+def version_info(conn):
     sys.stdout.write('\n-----\ndupReport: A summary email report generator for Duplicati.\n')
     sys.stdout.write('Program Version {}.{}.{}\n'.format(version[0], version[1], version[2]))
     
-    maj, min, subm, res = curr_db_version()
+    maj, min, subm, res = curr_db_version(conn)
     sys.stdout.write('Database Version {}.{}.{}\n'.format(maj, min, subm))
 
     sys.stdout.write('Copyright (c) {} Stephen Fried for HandyGuy Software.\n'.format(copyright))
@@ -291,8 +526,9 @@ def version_info():
     return
 
 def get_script_path():
-    # Get directory path where script is running
-    return os.path.dirname(os.path.realpath(sys.argv[0]))
+    # Get directory path dupReport.py is in. Default location for .rc, database & log files
+    # Uses this file rather than sys.argv[0], which is the calling program's script when used as a library
+    return os.path.dirname(os.path.realpath(__file__))
 
 def search_message_part(msgField, regex, multiLine, typ):
 # Search for field in message
@@ -325,66 +561,126 @@ def search_message_part(msgField, regex, multiLine, typ):
     return retData
 
 # Check database for existing message ID
-def db_search_message(messId):
+# emailDate (YYYY-MM-DD) is used to find the archive database to check if message isn't in the main database
+def db_search_message(conn, opts, messId, emailDate=None):
 
     write_log_entry(1,'db_search_message() for messageId=[{}]'.format(messId))
-    sqlStmt = "SELECT messageId FROM emails WHERE messageId=\'{}\'".format(messId)
-    write_log_entry(3,'{}'.format(sqlStmt))
-    dbCursor = exec_sqlite(dbConn,sqlStmt)
+    dbCursor = exec_sqlite(conn, 'SELECT messageId FROM emails WHERE messageId=?', (messId,))
     idExists = dbCursor.fetchone()
     if idExists:
         write_log_entry(2,'Message [{}] already in email database'.format(messId))
         return True
+
+    # Old message still on the server. May have been moved to an archive database.
+    # Backup end date can be a bit before the email date, so check the year before too. That includes current year emails:
+    # a report sent on January 1 for a backup that ended December 31 is in last year's archive after --rollover.
+    # Archive is opened with its own short-lived connection rather than attached: collection may be in the
+    # middle of a transaction (where ATTACH isn't allowed), and long-running users shouldn't collect attachments.
+    if emailDate is not None:
+        archYears = archive_years(opts)
+        for year in (int(emailDate[:4]), int(emailDate[:4]) - 1):
+            if year in archYears:
+                archConn = sqlite3.connect(archive_path(opts, year), timeout=opts['busytimeout'])
+                try:
+                    idExists = exec_sqlite(archConn, 'SELECT messageId FROM emails WHERE messageId=?', (messId,)).fetchone()
+                finally:
+                    archConn.close()
+                if idExists:
+                    write_log_entry(2,'Message [{}] already in archive database {}'.format(messId, archive_path(opts, year)))
+                    return True
     return False
 
 # Check database for existing source/destination pair
-# Insert if it doesn't exist
-def db_search_srcdest_pair(src, dest):
+# Insert if it doesn't exist. Caller commits.
+def db_search_srcdest_pair(conn, src, dest):
     write_log_entry(1, 'db_search_srcdest_pair({}, {})'.format(src, dest))
-    sqlStmt = "SELECT source, destination FROM backupsets WHERE source=\'{}\' AND destination=\'{}\'".format(src, dest)
-    write_log_entry(3, '{}'.format(sqlStmt))
-    dbCursor = exec_sqlite(dbConn, sqlStmt)
+    dbCursor = exec_sqlite(conn, 'SELECT source, destination FROM backupsets WHERE source=? AND destination=?', (src, dest))
     idExists = dbCursor.fetchone()
     if idExists:
         write_log_entry(2, "Source/Destination pair [{}/{}] already in database.".format(src, dest))
         return True
 
-    sqlStmt = "INSERT INTO backupsets (source, destination, lastFileCount, lastFileSize, lastDate, lastTime) \
-        VALUES ('{}', '{}', 0, 0, \'2000-01-01\', \'00:00:00\')".format(src, dest)
-    write_log_entry(3, '{}'.format(sqlStmt))
-    exec_sqlite(dbConn, sqlStmt)
-    dbConn.commit()
+    exec_sqlite(conn, "INSERT INTO backupsets (source, destination, lastFileCount, lastFileSize, lastDate, lastTime) \
+        VALUES (?, ?, 0, 0, \'2000-01-01\', \'00:00:00\')", (src, dest))
     write_log_entry(2, "Pair [{}/{}] added to database".format(src, dest))
 
     return False
 
 
-def convert_date_time(dtString):
-    # Convert dates & times to normlalized forms. Input=[YYYY/MM/DD HH:MM:SS AM/PM ]
-    write_log_entry(1, 'convert_date_time({})'.format(dtString))
+# Convert dates & times to normalized forms - YYYY/MM/DD  HH:MM:SS
+# Handles Duplicati's 12-hour format (HH:MM:SS AM/PM) as well as 24-hour times.
+# dateFormat gives the order of the date fields, from [main]dateformat: 'MDY' (Duplicati default), 'DMY' or 'YMD'.
+# Fields can be separated by '/', '.' or '-'. The order is never guessed from the values, so every date is read the same way.
+# Raises ValueError if the date can't be read with dateFormat
+# Timestamps repeat a lot between messages, so results are cached and each distinct string is only parsed once
+@functools.lru_cache(maxsize=1024)
+def convert_date_time(dtString, dateFormat):
+    write_log_entry(1, 'convert_date_time({}, {})'.format(dtString, dateFormat))
     if dtString == '':
         return None
 
-    dtSplit = dtString.split(' ')  # Split dtString into [<date>,<time>,<AM/PM>]
+    dtSplit = dtString.split()  # Split dtString into [<date>,<time>,<AM/PM>, ...]
 
-    datePart = re.split('/', dtSplit[0])
-    endDate = "{:04d}/{:02d}/{:02d}".format(int(datePart[2]),int(datePart[0]),int(datePart[1]))
+    datePart = re.split(r'[/.-]', dtSplit[0])
+    if len(datePart) != 3:
+        raise ValueError('Date [{}] does not have 3 parts'.format(dtSplit[0]))
+    fields = dict(zip(dateFormat, (int(part) for part in datePart)))
+    year, month, day = fields['Y'], fields['M'], fields['D']
+    datetime.date(year, month, day)    # Check it's a real date. Raises ValueError if not
+    endDate = "{:04d}/{:02d}/{:02d}".format(year, month, day)
 
-    timePart = re.split(':', dtSplit[1])
+    # Time may be missing seconds or have fractional seconds
+    timePart = (dtSplit[1].split(':') + ['0', '0'])[:3] if len(dtSplit) > 1 else ['0', '0', '0']
+    hour = int(timePart[0])
+    minute = int(timePart[1])
+    second = int(timePart[2].split('.')[0].split(',')[0])
 
-    if ((timePart[0] == "12") and (dtSplit[2] == 'AM')):
-        timePart[0] = '00'
-    elif ((timePart[0] != "12") and (dtSplit[2] == 'PM')):
-        timePart[0] = int(timePart[0]) + 12
+    # AM/PM marker may be 'AM', 'am', 'a.m.', etc.
+    ampm = dtSplit[2].replace('.', '').upper() if len(dtSplit) > 2 else ''
+    if (hour == 12) and (ampm == 'AM'):
+        hour = 0
+    elif (hour != 12) and (ampm == 'PM'):
+        hour = hour + 12
 
-    endTime = "{:02d}:{:02d}:{:02d}".format(int(timePart[0]),int(timePart[1]),int(timePart[2]))
+    endTime = "{:02d}:{:02d}:{:02d}".format(hour, minute, second)
 
     write_log_entry(2, 'Converted: date=[{}] time=[{}]\n'.format(endDate, endTime))
 
     return (endDate, endTime)
 
 
+# Compile the regular expressions used to pick apart message subjects
+# Cached so each combination of rc file settings is only compiled once
+@functools.lru_cache(maxsize=16)
+def compile_subject_regex(subjectRegex, srcRegex, destRegex, delimiter):
+    return (re.compile(subjectRegex),
+        re.compile('{}{}'.format(srcRegex, re.escape(delimiter))),
+        re.compile('{}{}'.format(re.escape(delimiter), destRegex)))
+
+# Get source & destination computers from message subject
+# Returns:
+#   None - Not a message of interest (subject doesn't match subjectregex)
+#   (None, None) - Message of interest, but srcdestdelimiter not found
+#   (source, destination) - Source & destination names
+# Subjects repeat for every run of a backup job, so results are cached by subject string
+@functools.lru_cache(maxsize=4096)
+def parse_subject(subject, subjectRegex, srcRegex, destRegex, delimiter):
+    subjectPat, srcPat, destPat = compile_subject_regex(subjectRegex, srcRegex, destRegex, delimiter)
+
+    # Match subject field against 'subjectregex' parameter from RC file (Default: 'Duplicati Backup report for...'
+    if subjectPat.search(subject) is None:
+        return None
+
+    partsSrc = srcPat.search(subject)
+    partsDest = destPat.search(subject)
+    if (partsSrc is None) or (partsDest is None):    # Correct subject but delim not found. Something is wrong.
+        return (None, None)
+
+    return (partsSrc.group().split(delimiter)[0], partsDest.group().split(delimiter)[1])
+
+
 # Build SQL statement to put into the emails table
+# Returns statement and list of values for its placeholders
 def build_email_sql_statement(mParts, sParts, dParts):
 
     write_log_entry(1, 'build_email_sql_statement(()')
@@ -397,9 +693,8 @@ def build_email_sql_statement(mParts, sParts, dParts):
         modifiedFolders, modifiedSymlinks, addedSymlinks, deletedSymlinks, partialBackup, \
         dryRun, mainOperation, parsedResult, verboseOutput, verboseErrors, endDate, endTime, \
         beginDate, beginTime, duration, messages, warnings, errors) \
-        VALUES \
-        ('{}', '{}', '{}', '{}', '{}', {}, {}, {}, {}, {}, {}, {}, {},{},{},{},{},{},{},{},{},{},{}, \
-        '{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', \"{}\", \"{}\", \"{}\")".format(mParts['messageId'], \
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    sqlParams = (mParts['messageId'], \
         mParts['sourceComp'], mParts['destComp'], mParts['emailDate'], mParts['emailTime'], sParts['deletedFiles'], \
         sParts['deletedFolders'], sParts['modifiedFiles'], sParts['examinedFiles'], sParts['openedFiles'], \
         sParts['addedFiles'], sParts['sizeOfModifiedFiles'], sParts['sizeOfAddedFiles'], sParts['sizeOfExaminedFiles'], sParts['sizeOfOpenedFiles'], \
@@ -408,15 +703,54 @@ def build_email_sql_statement(mParts, sParts, dParts):
         sParts['partialBackup'], sParts['dryRun'], sParts['mainOperation'], sParts['parsedResult'], sParts['verboseOutput'], \
         sParts['verboseErrors'], dParts['endSaveDate'], dParts['endSaveTime'], dParts['beginSaveDate'], dParts['beginSaveTime'], \
         sParts['duration'], sParts['messages'], sParts['warnings'], sParts['errors'])
-                
-    write_log_entry(3, 'sqlStmt=[{}]'.format(sqlStmt))
-    return sqlStmt
 
-# Split downloaded message into constituent parts
-def process_message(mess):
+    write_log_entry(3, 'sqlStmt=[{}] sqlParams=[{}]'.format(sqlStmt, sqlParams))
+    return sqlStmt, sqlParams
+
+# Find where the header block of a raw message ends (first empty line)
+# Returns length of message if there is no body
+def find_header_end(rawMsg):
+    ends = [pos for pos in (rawMsg.find(b'\r\n\r\n'), rawMsg.find(b'\n\n')) if pos != -1]
+    if not ends:
+        return len(rawMsg)
+    return min(ends) + 2
+
+# Get text of message body
+# Transfer encoding (base64, quoted-printable) is undone and text decoded with the message's charset.
+# Bad bytes are replaced rather than crashing the program
+def get_message_body(mess):
+    part = mess
+    if mess.is_multipart():    # Use the first plain text part
+        for subPart in mess.walk():
+            if subPart.get_content_type() == 'text/plain':
+                part = subPart
+                break
+        else:
+            return ''
+
+    payload = part.get_payload(decode=True)
+    if payload is None:
+        return ''
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    except LookupError:    # Unknown charset
+        return payload.decode('utf-8', errors='replace')
 
-    write_log_entry(1,'process_message()'.format(mess))
-    write_log_entry(2,'mess=[{}]'.format(mess))
+# Split downloaded message into constituent parts
+# rawMsg is the complete message as bytes, exactly as downloaded from the server
+# Only the header block is parsed until the message is known to be new and of interest
+# Returns:
+#   msgParts - Message stored in database
+#   0 - Message already in database from an earlier run
+#   1 - Message skipped (not a message of interest or can't be parsed)
+# Caller is responsible for committing the transaction
+def process_message(conn, opts, rawMsg):
+    import email.header
+    import email.utils
+    from email.parser import BytesParser
+
+    write_log_entry(1,'process_message()')
+    write_log_entry(3,'message size=[{}]'.format(len(rawMsg)))
     
     #Define lineParts
     #lineParts[] are the individual line items in the Duplicati status email report.
@@ -474,27 +808,37 @@ def process_message(mess):
     # dateParts contains the date & time strings for the SQL Query
     dateParts = {}
 
+    # Parse just the header block. The body is left alone until we know we want the message
+    mess = BytesParser().parsebytes(rawMsg[:find_header_end(rawMsg)], headersonly=True)
+
     # Get Message ID
+    if mess['Message-Id'] is None:
+        write_log_entry(1, 'Message has no Message-Id header. Skipping.')
+        return 1
     decode =  email.header.decode_header(mess['Message-Id'])[0]
     write_log_entry(3, 'decode=[{}]'.format(decode))
     msgParts['messageId'] = decode[0]
     if (type(msgParts['messageId']) is not str): # Email encoded as a byte object - See Issue #14
-        msgParts['messageId'] = msgParts['messageId'].decode('utf-8')
+        msgParts['messageId'] = msgParts['messageId'].decode('utf-8', errors='replace')
     write_log_entry(3, 'messageId=[{}]'.format(msgParts['messageId']))
 
-    # See if the record is already in the database, meaning we've seen it before
-    if db_search_message(msgParts['messageId']):
-        return 1
-
-    # Message not yet in database. Proceed
-    write_log_entry(1, 'Message ID [{}] does not exist. Adding to DB'.format(msgParts['messageId']))
-
-    decode = email.header.decode_header(mess['Subject'])[0]
+    decode = email.header.decode_header(mess['Subject'] or '')[0]
     msgParts['subject'] = decode[0]
     if (type(msgParts['subject']) is not str):  # Email encoded as a byte object - See Issue #14
-        msgParts['subject'] = msgParts['subject'].decode('utf-8')
+        msgParts['subject'] = msgParts['subject'].decode(decode[1] or 'utf-8', errors='replace')
     write_log_entry(3, 'Subject=[{}]'.format(msgParts['subject']))
 
+    # See if it's a message of interest & get source & desination computers from email subject
+    # Check this first. It doesn't need a database lookup.
+    subjectParts = parse_subject(msgParts['subject'], opts['subjectregex'], opts['srcregex'], opts['destregex'], \
+        opts['srcdestdelimiter'])
+    if subjectParts is None:
+        write_log_entry(1, 'Message [{}] is not a Message of Interest.'.format(msgParts['messageId']))
+        return 1    # Not a message of Interest
+    if subjectParts[0] is None:    # Correct subject but delim not found. Something is wrong.
+        write_log_entry(2,'srcdestdelimiter [{}] not found in subject. Abandoning message.'.format(opts['srcdestdelimiter']))
+        return 1
+
     date_tuple = email.utils.parsedate_tz(mess['Date'])
     if date_tuple:
         local_date = datetime.datetime.fromtimestamp(email.utils.mktime_tz(date_tuple))
@@ -502,33 +846,22 @@ def process_message(mess):
         msgParts['emailTime'] = local_date.strftime("%H:%M:%S")
         write_log_entry(3, 'emailDate=[{}]  emailTime=[{}]'.format( msgParts['emailDate'], msgParts['emailTime']))
 
-    # See if it's a message of interest
-    # Match subjetc field against 'subjectregex' parameter from RC file (Default: 'Duplicati Backup report for...'
-    if re.search(options['subjectregex'], msgParts['subject']) == None:
-        write_log_entry(1, 'Message [{}] is not a Message of Interest.'.format(msgParts['messageId']))
-        return 1    # Not a message of Interest
+    # See if the record is already in the database, meaning we've seen it before
+    if db_search_message(conn, opts, msgParts['messageId'], msgParts.get('emailDate')):
+        return 0
 
-    # Get source & desination computers from email subject
-    srcRegex = '{}{}'.format(options['srcregex'], re.escape(options['srcdestdelimiter']))
-    destRegex = '{}{}'.format(re.escape(options['srcdestdelimiter']), options['destregex'])
-    write_log_entry(3,'srcregex=[{}]  destRegex=[{}]'.format(srcRegex, destRegex))
+    # Message not yet in database. Proceed
+    write_log_entry(1, 'Message ID [{}] does not exist. Adding to DB'.format(msgParts['messageId']))
 
-    partsSrc = re.search(srcRegex, msgParts['subject'])
-    partsDest = re.search(destRegex, msgParts['subject'])
-    if (partsSrc is None) or (partsDest is None):    # Correct subject but delim not found. Something is wrong.
-        write_log_entry(2,'srcdestdelimiter [{}] not found in subject. Abandoning message.'.format(options['srcdestdelimiter']))
-        return 1
-        
-    msgParts['sourceComp'] = re.search(srcRegex, msgParts['subject']).group().split(options['srcdestdelimiter'])[0]
-    msgParts['destComp'] = re.search(destRegex, msgParts['subject']).group().split(options['srcdestdelimiter'])[1]
+    msgParts['sourceComp'], msgParts['destComp'] = subjectParts
     write_log_entry(3, 'source=[{}] dest=[{}] Date=[{}]  Time=[{}] Subject=[{}]'.format(msgParts['sourceComp'], \
         msgParts['destComp'], msgParts['emailDate'], msgParts['emailTime'], msgParts['subject']))
 
     # Search for source/destination pair in database. Add if not already there
-    db_search_srcdest_pair(msgParts['sourceComp'], msgParts['destComp'])    
+    db_search_srcdest_pair(conn, msgParts['sourceComp'], msgParts['destComp'])    
 
-    # Extract the body (payload) from the email
-    msgParts['body'] = mess.get_payload()
+    # Extract the body (payload) from the email. Now it's worth parsing the whole thing
+    msgParts['body'] = get_message_body(BytesParser().parsebytes(rawMsg))
     write_log_entry(3, 'Body=[{}]'.format(msgParts['body']))
 
     # Go through each element in lineParts{}, get the value from the body, and assign it to the corresponding element in statusParts{}
@@ -539,11 +872,13 @@ def process_message(mess):
     write_log_entry(3, "statusParts['failed']=[{}]".format(statusParts['failed']))
     if statusParts['failed'] == '':  # Looks like a good run
         # Convert dates & times to normlalized forms - YYYY/MM/DD  HH:MM:SS
-        dateParts['endSaveDate'] = convert_date_time(statusParts['endTimeStr'])[0]
-        dateParts['endSaveTime'] = convert_date_time(statusParts['endTimeStr'])[1]
-
-        dateParts['beginSaveDate'] = convert_date_time(statusParts['beginTimeStr'])[0]
-        dateParts['beginSaveTime'] = convert_date_time(statusParts['beginTimeStr'])[1]
+        try:
+            dateParts['endSaveDate'], dateParts['endSaveTime'] = convert_date_time(statusParts['endTimeStr'], opts['dateformat'])
+            dateParts['beginSaveDate'], dateParts['beginSaveTime'] = convert_date_time(statusParts['beginTimeStr'], opts['dateformat'])
+        except (ValueError, TypeError) as err:    # Leave message on server. It can be collected after fixing dateformat
+            write_log_entry(1, 'Can\'t read dates [{}] [{}] with dateformat={}: {}. Skipping message.'.format(statusParts['endTimeStr'], \
+                statusParts['beginTimeStr'], opts['dateformat'], err))
+            return 1
     else:  # Something went wrong. Let's gather the details.
         statusParts['errors'] = statusParts['failed']
         statusParts['parsedResult'] = 'Failure'
@@ -568,57 +903,70 @@ def process_message(mess):
     write_log_entry(3, 'endSaveDate=[{}] endSaveTime=[{}] beginSaveDate=[{}] beginSaveTime=[{}]'.format(dateParts['endSaveDate'], \
         dateParts['endSaveTime'], dateParts['beginSaveDate'], dateParts['beginSaveTime']))
 
-    sqlStmt = build_email_sql_statement(msgParts, statusParts, dateParts)
-    write_log_entry(3, 'sqlStmt=[{}]'.format(sqlStmt))
-
-    dbCursor.execute(sqlStmt)
-    dbConn.commit()
+    sqlStmt, sqlParams = build_email_sql_statement(msgParts, statusParts, dateParts)
+    exec_sqlite(conn, sqlStmt, sqlParams)
 
     return msgParts
 
-# Build list of text strings for sending final email
-def create_email_text(txtTup,fmtTup):
+# Add a line to the report rows for the final email
+# Line is rendered once (see render_email_row()) and appended to rows as a (pair, text, html) tuple
+# pair = (source, destination) the text belongs to. None if it goes in every report
+def create_email_text(rows,txtTup,fmtTup,pair=None):
     write_log_entry(1, 'create_email_text()')
-    write_log_entry(2, 'textTup={}  fmtTup={}'.format(txtTup,fmtTup))
-
-    # Append text and formats tuples to email & format lists
-    emailText.append(txtTup)
-    emailFormat.append(fmtTup)
-
-# Send final email result
-def send_email():
-    write_log_entry(2, 'Send_email()')
-    msgText=''
-
-    # Begin HTML output
-    msgHtml='<html><head></head><body><table border={} cellpadding="{}">'.format(options['border'], options['padding'])
-
-    # Loop through all text & format entries & build message as we go
-    for txt,format in zip(emailText, emailFormat):
-        write_log_entry(3, 'txt={}  format={}'.format(txt, format))
-        msgHtml = msgHtml + '<tr>'  # New table row
-        if len(txt) == 1:  # Single line of data = header. Center & bold
-            msgText = msgText + '{}\n'.format(txt[0])
-            msgHtml = msgHtml + '<td align="center" colspan = "11"><b>{}</b></td>'.format(txt[0])
-        elif len(txt) == 2:  # Single line of data but != header. Center & italic
-            msgText = '{}{}\n'.format(msgText, txt[0])
-            msgHtml = '{}<td align="center" colspan = "11"><i>{}{}</i></td>'.format(msgHtml, txt[0], txt[1])
-        else:
-            for txt2,format2 in zip(txt,format):
-                write_log_entry(3, 'txt2={}  fmt2={}'.format(txt2,format2))
-                msgText = msgText + '{:{fmt}}'.format(txt2,fmt=format2)
-                msgHtml = msgHtml + '<td align="right">{:{fmt}}</td>'.format(txt2,fmt=format2)
-        msgText = msgText + '\n'
-        msgHtml = msgHtml + '</tr>\n'
-    msgHtml = msgHtml + '</table>\n'
+    write_log_entry(2, 'textTup={}  fmtTup={}  pair={}'.format(txtTup,fmtTup,pair))
+
+    rows.append((pair,) + render_email_row(txtTup, fmtTup))
+
+# Turn one line of report into plain text & HTML table row
+def render_email_row(txt, format):
+    write_log_entry(3, 'txt={}  format={}'.format(txt, format))
+    msgHtml = '<tr>'  # New table row
+    if len(txt) == 1:  # Single line of data = header. Center & bold
+        msgText = '{}\n'.format(txt[0])
+        msgHtml = msgHtml + '<td align="center" colspan = "11"><b>{}</b></td>'.format(txt[0])
+    elif len(txt) == 2:  # Single line of data but != header. Center & italic
+        msgText = '{}\n'.format(txt[0])
+        msgHtml = '{}<td align="center" colspan = "11"><i>{}{}</i></td>'.format(msgHtml, txt[0], txt[1])
+    else:
+        msgText = ''
+        for txt2,format2 in zip(txt,format):
+            write_log_entry(3, 'txt2={}  fmt2={}'.format(txt2,format2))
+            msgText = msgText + '{:{fmt}}'.format(txt2,fmt=format2)
+            msgHtml = msgHtml + '<td align="right">{:{fmt}}</td>'.format(txt2,fmt=format2)
+    msgText = msgText + '\n'
+    msgHtml = msgHtml + '</tr>\n'
+    return msgText, msgHtml
+
+# Assemble report text & HTML from rendered rows
+# rows = list of (pair, text, html) tuples. Only rows for which includePair(pair) is true (or that belong to every report) are used
+def render_report(opts, rows, subject, includePair):
+    # Report title
+    msgText, msgHtml = render_email_row((subject+'\n',), ('^',))
+    msgText = [msgText]
+    msgHtml = ['<html><head></head><body><table border={} cellpadding="{}">'.format(opts['border'], opts['padding']), msgHtml]
+    for pair, txt, html in rows:
+        if (pair is None) or includePair(pair):
+            msgText.append(txt)
+            msgHtml.append(html)
+    msgHtml.append('</table>\n')
+    msgText = ''.join(msgText)
+    msgHtml = ''.join(msgHtml)
     write_log_entry(3, 'msgtext={}'.format(msgText))
     write_log_entry(3, 'msgHtml={}'.format(msgHtml))
+    return msgText, msgHtml
+
+# Build report email message from rendered rows (see render_report())
+def build_email(rows, subject, receiver, includePair):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msgText, msgHtml = render_report(options, rows, subject, includePair)
 
     # Build email message
     msg = MIMEMultipart('alternative')
-    msg['Subject'] = options['summarysubject']
+    msg['Subject'] = subject
     msg['From'] = options['outsender']
-    msg['To'] = options['outreceiver']
+    msg['To'] = receiver
 
     # Record the MIME types of both parts - text/plain and text/html.
     part1 = MIMEText(msgText, 'plain')
@@ -630,78 +978,268 @@ def send_email():
     msg.attach(part1)
     msg.attach(part2)
 
-    # Send the message via local SMTP server.
+    return msg
+
+# Open & log into outgoing SMTP server
+def smtp_connect():
+    import smtplib
+
     server = smtplib.SMTP('{}:{}'.format(options['outserver'], options['outport']))
     write_log_entry(2, 'SMTP Server=[{}]'.format(server))
     if options['outencryption'] == 'tls':   # Do we need to use SSL/TLS?
         server.starttls()
     server.login(options['outaccount'], options['outpassword'])
-    server.sendmail(options['outsender'], options['outreceiver'], msg.as_string())
-    server.quit() 
-    
+    return server
+
+# Send list of email messages
+# Connections are opened once and reused for all messages. Up to [outgoing]maxconnections are used in parallel.
+# Transient failures (dropped connections, 4xx responses) are retried with increasing delay.
+def send_messages(msgs):
+    write_log_entry(1, 'send_messages({} messages)'.format(len(msgs)))
+    import smtplib
+    import threading
+
+    connLocal = threading.local()    # Each worker thread keeps its own connection
+    connList = []                    # All open connections, so they can be closed at the end
+    connLock = threading.Lock()
+
+    def send_one(msg):
+        receivers = [addr.strip() for addr in msg['To'].split(',')]
+        for attempt in range(options['outretries'] + 1):
+            try:
+                if getattr(connLocal, 'server', None) is None:
+                    connLocal.server = smtp_connect()
+                    with connLock:
+                        connList.append(connLocal.server)
+                connLocal.server.sendmail(options['outsender'], receivers, msg.as_string())
+                write_log_entry(1, 'Sent report [{}] to {}'.format(msg['Subject'], msg['To']))
+                return True
+            # SMTPException is a subclass of OSError, so the SMTP cases have to come before plain OSError
+            except smtplib.SMTPServerDisconnected as err:
+                write_log_entry(1, 'Connection error sending report [{}]: {}'.format(msg['Subject'], err))
+                connLocal.server = None
+            except smtplib.SMTPResponseException as err:
+                if err.smtp_code < 400 or err.smtp_code >= 500:    # Permanent failure. Don't bother retrying
+                    write_log_entry(1, 'Error sending report [{}] to {}: {}'.format(msg['Subject'], msg['To'], err))
+                    return False
+                write_log_entry(1, 'Temporary error sending report [{}]: {}'.format(msg['Subject'], err))
+                connLocal.server = None
+            except smtplib.SMTPException as err:    # E.g., all recipients refused. Retrying won't help
+                write_log_entry(1, 'Error sending report [{}] to {}: {}'.format(msg['Subject'], msg['To'], err))
+                return False
+            except OSError as err:    # Network trouble
+                write_log_entry(1, 'Connection error sending report [{}]: {}'.format(msg['Subject'], err))
+                connLocal.server = None
+            if attempt < options['outretries']:
+                time.sleep(options['outretrydelay'] * (2 ** attempt))
+        write_log_entry(1, 'Giving up sending report [{}] to {}'.format(msg['Subject'], msg['To']))
+        return False
+
+    if (options['outmaxconnections'] <= 1) or (len(msgs) <= 1):
+        results = [send_one(msg) for msg in msgs]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(options['outmaxconnections'], len(msgs))) as executor:
+            results = list(executor.map(send_one, msgs))
+
+    for server in connList:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):    # Already gone. Don't care.
+            pass
+
+    return results
+
+# Send final email result
+# rows = rendered report lines from create_summary_report()
+# Main report goes to [outgoing]receiver. Each [report:<name>] group gets a report with just its own pairs.
+def send_email(rows):
+    write_log_entry(2, 'Send_email()')
+
+    # Group reports are assembled from the already rendered lines
+    msgs = [build_email(rows, options['summarysubject'], options['outreceiver'], lambda pair: True)]
+    for group in options['reportgroups']:
+        includePair = lambda pair, group=group: (group['srcregex'].search(pair[0]) is not None) and \
+            (group['destregex'].search(pair[1]) is not None)
+        msgs.append(build_email(rows, group['subject'], group['receiver'], includePair))
+
+    send_messages(msgs)
+
+
+# Look for unusual runs in the backup history of every source/destination pair
+# History for all pairs is loaded with one query per batch of tables and analyzed with NumPy, so cost doesn't depend on the number of pairs
+# Archives are attached in batches, so call outside of a transaction
+# Returns dictionary of {(source, destination, endDate, endTime): [annotation, ...]} for flagged runs
+def detect_anomalies(conn, opts):
+    write_log_entry(1, 'detect_anomalies()')
+
+    try:
+        import numpy
+    except ImportError:
+        write_log_entry(1, 'Anomaly detection requires NumPy, which is not installed. Skipping.')
+        return {}
+
+    window = opts['anomalywindow']
+    threshold = opts['anomalythreshold']
+
+    # Only look back [main]anomalyhistory days
+    # Failed jobs have no file counts, so leave them out of the statistics
+    # Up to 9 archives are attached at a time, leaving room under Sqlite's limit of 10
+    since = (datetime.date.today() - datetime.timedelta(days=opts['anomalyhistory'])).strftime('%Y/%m/%d')
+    rows = []
+    for tables in history_table_batches(conn, opts, history_years(opts, since), 9):
+        sqlStmt = ' UNION ALL '.join("SELECT sourceComp, destComp, endDate, endTime, sizeOfExaminedFiles, examinedFiles, modifiedFiles \
+            FROM {} WHERE parsedResult != 'Failure' AND endDate >= ?".format(table) for table in tables)
+        write_log_entry(2, 'sqlStmt=[{}]'.format(sqlStmt))
+        rows.extend(exec_sqlite(conn, sqlStmt, (since,) * len(tables)).fetchall())
+    rows.sort(key=lambda row: row[:4])    # Group rows by pair, oldest run first
+    numRows = len(rows)
+    write_log_entry(2, 'Analyzing {} history rows'.format(numRows))
+    if numRows == 0:
+        return {}
+
+    cols = list(zip(*rows))
+    sources = numpy.array(cols[0], dtype=object)
+    dests = numpy.array(cols[1], dtype=object)
+    values = numpy.array(cols[4:7], dtype=numpy.float64).T    # One column each for size, file count, modified files
+
+    # Find where each pair's history starts. Rows are sorted by pair, so a new pair starts wherever src or dest changes
+    newPair = numpy.ones(numRows, dtype=bool)
+    newPair[1:] = (sources[1:] != sources[:-1]) | (dests[1:] != dests[:-1])
+    pairStart = numpy.flatnonzero(newPair)[numpy.cumsum(newPair) - 1]
+
+    # Rolling window = up to 'window' previous runs of the same pair (current run not included)
+    # Window sums are added up one lag at a time, masked to the pair's own runs, so no pair's statistics
+    # depend on the pairs sorted before it. Variance is taken around the window mean to stay accurate for big sizes.
+    idx = numpy.arange(numRows)
+    winStart = numpy.maximum(pairStart, idx - window)
+    count = (idx - winStart)[:, None]
+    lags = [((idx - lag >= pairStart)[:, None], values[idx - lag]) for lag in range(1, window + 1)]
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = sum(numpy.where(inWindow, lagValues, 0.0) for inWindow, lagValues in lags) / count
+        var = sum(numpy.where(inWindow, (lagValues - mean) ** 2, 0.0) for inWindow, lagValues in lags) / count
+        # Floor the std dev at [main]anomalyminstddev percent of the average (and at least 1) so perfectly
+        # constant histories don't turn every tiny change into a huge score
+        minStdDev = numpy.maximum(opts['anomalyminstddev'] / 100.0 * numpy.abs(mean), 1.0)
+        stdDev = numpy.maximum(numpy.sqrt(numpy.maximum(var, 0)), minStdDev)
+        zScore = (values - mean) / stdDev
+
+    # Size growth over the window. Runs with no size to grow from (0) aren't rated
+    base = values[winStart, 0]
+    growth = numpy.zeros(numRows)
+    numpy.divide((values[:, 0] - base) * 100, base, out=growth, where=base > 0)
+
+    enoughHistory = count[:, 0] >= 3
+    zFlags = enoughHistory[:, None] & (numpy.abs(zScore) > threshold)
+    zFlags[:, 2] &= zScore[:, 2] > 0     # Only spikes in modified files are interesting, not quiet days
+    growthFlags = (count[:, 0] == window) & (growth > opts['anomalygrowth'])
+
+    anomalies = {}
+    labels = ('Backup size', 'File count', 'Modified files')
+    for i in numpy.flatnonzero(zFlags.any(axis=1) | growthFlags):
+        notes = []
+        for col in numpy.flatnonzero(zFlags[i]):
+            notes.append('{} {} {:,.0f} ({:+.1f} std devs from {}-run average of {:,.0f})'.format(labels[col], \
+                'up to' if zScore[i, col] > 0 else 'down to', values[i, col], zScore[i, col], count[i, 0], mean[i, col]))
+        if growthFlags[i]:
+            notes.append('Backup size grew {:.0f}% over last {} runs'.format(growth[i], window))
+        anomalies[rows[i][:4]] = notes
+        write_log_entry(2, 'Anomaly {}: {}'.format(rows[i][:4], notes))
+
+    write_log_entry(1, '{} anomalies found'.format(len(anomalies)))
+    return anomalies
+
 
 # Create summary report to email
-# Creates tuples of fields and formats
-# Add those tuples to final email through create_email_text()
-def create_summary_report():
+# Creates tuples of fields and formats & adds them to report rows through create_email_text()
+# Returns list of rendered report rows (see render_report())
+def create_summary_report(conn, opts):
 
     write_log_entry(1, 'create_summary_report()')
     sqlStmt = "SELECT source, destination, lastDate, lastTime, lastFileCount, lastFileSize from backupsets"
     # How should report be sorted?
-    if options['sortorder'] == 'source':
+    if opts['sortorder'] == 'source':
         sqlStmt = sqlStmt + " order by source, destination"
     else:
         sqlStmt = sqlStmt + " order by destination, source"
     write_log_entry(2, 'sqlStmt=[{}]'.format(sqlStmt))
 
-    tupFields = (options['summarysubject']+'\n',)
-    tupFormats = ('^',)
-    create_email_text(tupFields, tupFormats)
-
-    if options['sizereduce'] == 'mega':   # Convert sizes to megabytes
+    if opts['sizereduce'] == 'mega':   # Convert sizes to megabytes
         tupFields = ('Date','Time','Files','+/-','Size (MB)','+/- (MB)','Added','Deleted','Modified','Errors','Result')
-    elif options['sizereduce'] == 'giga': # Convert sizes to gigabytes
+    elif opts['sizereduce'] == 'giga': # Convert sizes to gigabytes
         tupFields = ('Date','Time','Files','+/-','Size (GB)','+/- (GB)','Added','Deleted','Modified','Errors','Result')
     else:   # Report normal sizes
         tupFields = ('Date','Time','Files','+/-','Size','+/-','Added','Deleted','Modified','Errors','Result')
  
     tupFormats = ('11','9','>10','10','>18','18','>10','>10','>10','>10','<11')   # string formats for fields
-    create_email_text(tupFields, tupFormats)
+    reportRows = []
+    create_email_text(reportRows, tupFields, tupFormats)
 
-    # Loop through backupsets table and then get latest actibity for each src/dest pair
-    dbCursor = exec_sqlite(dbConn, sqlStmt)
+    # Do all reads inside one read transaction. With WAL, that gives a consistent snapshot
+    # of the database while the collector keeps adding emails, without blocking it.
+    # backupsets updates are saved up & written in one short transaction at the end.
+    conn.commit()
+
+    # Flag unusual runs, if requested. Archives can't be attached inside a transaction, so do it first.
+    if opts['anomalies'] == True:
+        anomalies = detect_anomalies(conn, opts)
+    else:
+        anomalies = {}
+
+    exec_sqlite(conn, 'BEGIN')
+    bkSetUpdates = {}
+
+    # Get new activity for all pairs in one query. Pairs with nothing new since the last report don't show up here at all
+    # endDate >= lastDate lets Sqlite seek each pair's srcdestdateindx range instead of checking all its emails
+    activityStmt = 'SELECT e.sourceComp, e.destComp, e.endDate, e.endtime, e.examinedFiles, e.sizeOfExaminedFiles, e.addedFiles, \
+        e.deletedFiles, e.modifiedFiles, e.filesWithError, e.parsedResult, e.warnings, e.errors, e.messages \
+        FROM backupsets b JOIN emails e ON e.sourceComp = b.source AND e.destComp = b.destination \
+        WHERE (e.endDate >= b.lastDate) AND ((e.endDate > b.lastDate) OR (e.endtime > b.lastTime)) order by e.endDate, e.endTime'
+    write_log_entry(3, 'activityStmt=[{}]'.format(activityStmt))
+    dbCursor = exec_sqlite(conn, activityStmt)
+    newActivity = {}
+    for row in dbCursor.fetchall():
+        newActivity.setdefault((row[0], row[1]), []).append(row[2:])
+
+    # Lines for pairs with no new activity only change when the last activity or the date ("N days ago") changes
+    # They're saved rendered in the reportfragments table, so later reports the same day (e.g., hourly cron runs) reuse them
+    nowTxt = datetime.datetime.now()
+    today = nowTxt.date()
+    reportDate = today.strftime('%Y/%m/%d')
+    dbCursor = exec_sqlite(conn, 'SELECT source, destination, lastDate, lastTime, text, html FROM reportfragments WHERE reportDate = ?', \
+        (reportDate,))
+    idleFragments = {row[:4]: row[4:] for row in dbCursor.fetchall()}
+    newFragments = []
+
+    # Loop through backupsets table and then report latest actibity for each src/dest pair
+    dbCursor = exec_sqlite(conn, sqlStmt)
     bkSetRows = dbCursor.fetchall()
     write_log_entry(2, 'bkSetRows=[{}]'.format(bkSetRows))
     for source, destination, lastDate, lastTime, lastFileCount, lastFileSize in bkSetRows:
         write_log_entry(3, 'Src=[{}] Dest=[{}] lastDate=[{}] lastTime=[{}] lastFileCount=[{}] lastFileSize=[{}]'.format(source, 
             destination, lastDate, lastTime, lastFileCount, lastFileSize))
-        tupFields = ('***** {} to {} *****'.format(source, destination),)
-        tupFormats = ('',)
-        create_email_text(tupFields, tupFormats)
-
-        # Select all activity for src/dest pair since last report run
-        sqlStmt = 'SELECT endDate, endtime, examinedFiles, sizeOfExaminedFiles, addedFiles, deletedFiles, modifiedFiles, \
-            filesWithError, parsedResult, warnings, errors, messages FROM emails WHERE sourceComp=\'{}\' AND destComp=\'{}\' \
-            AND  ((endDate > \'{}\') OR  ((endDate == \'{}\') AND (endtime > \'{}\'))) order by endDate, endTime'.format(source, \
-            destination, lastDate, lastDate, lastTime)
-        write_log_entry(3, 'sqlStmt=[{}]'.format(sqlStmt))
-
-        dbCursor = exec_sqlite(dbConn, sqlStmt)
-        emailRows = dbCursor.fetchall()
+        pair = (source, destination)
+
+        emailRows = newActivity.get(pair)
         write_log_entry(3, 'emailRows=[{}]'.format(emailRows))
         if not emailRows: #NO rows found = no recent activity
-            # Calculate days since last activity
-            nowTxt = datetime.datetime.now()
-            now = str(datetime.datetime.now()).split(' ')[0].split('-')
-            then = lastDate.split('/')
-            write_log_entry(3, 'nowTxt=[{}]  now=[{}]  then=[{}]'.format(nowTxt, now, then))
-            d0 = datetime.date(int(then[0]),int(then[1]), int(then[2]))
-            d1 = datetime.date(int(now[0]),int(now[1]), int(now[2]))
-            write_log_entry(3, 'd0=[{}]  d1=[{}]'.format(d0, d1))
-            tupFields = ('No new activity. Last activity on {} at {} ({} days ago)'.format(lastDate, lastTime, (d1-d0).days),'',)
-            tupFormats = ('','',)
-            create_email_text(tupFields, tupFormats)
+            fragment = idleFragments.get((source, destination, lastDate, lastTime))
+            if fragment is None:
+                # Calculate days since last activity
+                then = lastDate.split('/')
+                write_log_entry(3, 'nowTxt=[{}]  then=[{}]'.format(nowTxt, then))
+                d0 = datetime.date(int(then[0]),int(then[1]), int(then[2]))
+                write_log_entry(3, 'd0=[{}]  d1=[{}]'.format(d0, today))
+                fragRows = []
+                create_email_text(fragRows, ('***** {} to {} *****'.format(source, destination),), ('',), pair)
+                create_email_text(fragRows, ('No new activity. Last activity on {} at {} ({} days ago)'.format(lastDate, lastTime, \
+                    (today-d0).days),'',), ('','',), pair)
+                fragment = (''.join(row[1] for row in fragRows), ''.join(row[2] for row in fragRows))
+                newFragments.append((source, destination, lastDate, lastTime, reportDate) + fragment)
+            reportRows.append((pair,) + fragment)
         else:
+            create_email_text(reportRows, ('***** {} to {} *****'.format(source, destination),), ('',), pair)
             # Loop through each new activity and report
             for endDate, endtime, examinedFiles, sizeOfExaminedFiles, addedFiles, deletedFiles, modifiedFiles, \
                 filesWithError, parsedResult, warnings, errors, messages in emailRows:
@@ -713,11 +1251,11 @@ def create_summary_report():
                 fileSizeDelta = sizeOfExaminedFiles - lastFileSize
                 write_log_entry(3, 'fileSizeDelta = {} - {} = {}'.format(sizeOfExaminedFiles, lastFileSize, fileSizeDelta))
 
-                if options['sizereduce'] == 'mega': 
+                if opts['sizereduce'] == 'mega': 
                     tupFields = (endDate, endtime, examinedFiles, examinedFilesDelta, (sizeOfExaminedFiles / 1000000.00), (fileSizeDelta / 1000000.00), \
                         addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult)
                     tupFormats = ('13','11','>12,','>+12,','>15,.2f','>+15,.2f','>12,','>12,','>12,','>12,','>13')
-                elif options['sizereduce'] == 'giga':
+                elif opts['sizereduce'] == 'giga':
                     tupFields = (endDate, endtime, examinedFiles, examinedFilesDelta, (sizeOfExaminedFiles / 1000000000.00), (fileSizeDelta / 1000000000.00), \
                         addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult)
                     tupFormats = ('13','11','>12,','>+12,','>12,.2f','>+12,.2f','>12,','>12,','>12,','>12,','>13')
@@ -726,93 +1264,433 @@ def create_summary_report():
                         addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult)
                     tupFormats = ('13','11','>12,','>+12,','>20,','>+20,','>12,','>12,','>12,','>12,','>13')
 
-                create_email_text(tupFields, tupFormats)
+                create_email_text(reportRows, tupFields, tupFormats, pair)
 
-                if ((errors != '') and (options['disperrors'] == True)):
-                    create_email_text((errors,'',),('','',))
-                if ((warnings != '') and (options['dispwarnings'] == True)):
-                    create_email_text((warnings,'',),('','',))
-                if ((messages != '') and (options['dispmessages'] == True)):
-                    create_email_text((messages,'',),('','',))
+                for note in anomalies.get((source, destination, endDate, endtime), []):
+                    create_email_text(reportRows, ('ANOMALY: {}'.format(note),'',),('','',), pair)
 
-                # Update latest activity into into backupsets
-                sqlStmt = 'UPDATE backupsets SET lastFileCount={}, lastFileSize={}, lastDate=\'{}\', \
-                    lasttime=\'{}\' WHERE source=\'{}\' AND destination=\'{}\''.format(examinedFiles, sizeOfExaminedFiles, \
-                    endDate, endtime, source, destination)
-                write_log_entry(3, 'sqlStmt=[{}]'.format(sqlStmt))
+                if ((errors != '') and (opts['disperrors'] == True)):
+                    create_email_text(reportRows, (errors,'',),('','',), pair)
+                if ((warnings != '') and (opts['dispwarnings'] == True)):
+                    create_email_text(reportRows, (warnings,'',),('','',), pair)
+                if ((messages != '') and (opts['dispmessages'] == True)):
+                    create_email_text(reportRows, (messages,'',),('','',), pair)
 
-                dbCursor = exec_sqlite(dbConn, sqlStmt)
-                dbConn.commit()
+                # Remember latest activity for backupsets update
+                bkSetUpdates[(source, destination)] = (examinedFiles, sizeOfExaminedFiles, endDate, endtime)
 
                 # Set last file count & size the latest information
                 lastFileCount = examinedFiles
                 lastFileSize = sizeOfExaminedFiles
 
+    # End read transaction
+    conn.commit()
+
+    # Update latest activity into into backupsets
+    sqlStmt = 'UPDATE backupsets SET lastFileCount=?, lastFileSize=?, lastDate=?, lastTime=? WHERE source=? AND destination=?'
+    write_log_entry(3, 'sqlStmt=[{}] updates=[{}]'.format(sqlStmt, bkSetUpdates))
+    conn.executemany(sqlStmt, [vals + pair for pair, vals in bkSetUpdates.items()])
+
+    # Save new lines for idle pairs (one per pair) & drop ones from earlier days
+    write_log_entry(2, 'Reused {} idle pair lines. Saving {} new ones'.format(len(bkSetRows) - len(newActivity) - len(newFragments), \
+        len(newFragments)))
+    exec_sqlite(conn, 'DELETE FROM reportfragments WHERE reportDate != ?', (reportDate,))
+    conn.executemany('INSERT OR REPLACE INTO reportfragments (source, destination, lastDate, lastTime, reportDate, text, html) \
+        VALUES (?,?,?,?,?,?,?)', newFragments)
+    conn.commit()
+
+    return reportRows
+
+
+# Export emails table to JSON Lines or CSV
+# Rows are streamed through fetchmany() so memory use stays constant no matter how big the table gets
+def export_emails(conn, chunkSize=1000):
+    write_log_entry(1, 'export_emails()')
+    import json
+    import csv
+    import gzip
+
+    # Build WHERE clause from any filters given on the command line
+    # Dates can be given as YYYY/MM/DD or YYYY-MM-DD. Database dates use '/'
+    fromDate = options['exportfrom'].replace('-','/') if options['exportfrom'] != None else None
+    toDate = options['exportto'].replace('-','/') if options['exportto'] != None else None
+    whereParts = []
+    sqlParams = []
+    if options['exportsrc'] != None:
+        whereParts.append('sourceComp = ?')
+        sqlParams.append(options['exportsrc'])
+    if options['exportdest'] != None:
+        whereParts.append('destComp = ?')
+        sqlParams.append(options['exportdest'])
+    if fromDate != None:
+        whereParts.append('endDate >= ?')
+        sqlParams.append(fromDate)
+    if toDate != None:
+        whereParts.append('endDate <= ?')
+        sqlParams.append(toDate)
+
+    # Open output. '-' = stdout, '*.gz' = gzip-compressed file
+    if options['export'] == '-':
+        outFile = sys.stdout
+    elif options['export'].endswith('.gz'):
+        outFile = gzip.open(options['export'], 'wt', encoding='utf-8', newline='')
+    else:
+        outFile = open(options['export'], 'w', encoding='utf-8', newline='')
+
+    # Export from each archive database in the date range, then the main database
+    numRows = 0
+    csvWriter = None
+    for tables in history_table_batches(conn, options, history_years(options, fromDate, toDate)):
+        # No ORDER BY. Rows come back in insertion order without forcing Sqlite to sort the whole table
+        sqlStmt = 'SELECT * FROM {}'.format(tables[0])
+        if whereParts:
+            sqlStmt = sqlStmt + ' WHERE ' + ' AND '.join(whereParts)
+        write_log_entry(2, 'sqlStmt=[{}] params=[{}]'.format(sqlStmt, sqlParams))
+
+        dbCursor = exec_sqlite(conn, sqlStmt, sqlParams)
+        colNames = [col[0] for col in dbCursor.description]
+        if (options['exportformat'] == 'csv') and (csvWriter is None):    # Header row only once
+            csvWriter = csv.writer(outFile)
+            csvWriter.writerow(colNames)
+
+        while True:
+            rows = dbCursor.fetchmany(chunkSize)
+            if not rows:
+                break
+            if options['exportformat'] == 'csv':
+                csvWriter.writerows(rows)
+            else:
+                outFile.writelines(json.dumps(dict(zip(colNames, row))) + '\n' for row in rows)
+            numRows = numRows + len(rows)
+            write_log_entry(3, 'Exported {} rows'.format(numRows))
+
+    if outFile is not sys.stdout:
+        outFile.close()
+    write_log_entry(1, 'Exported {} rows to {}'.format(numRows, options['export']))
+    return numRows
+
+
+# Latest backup & last reported activity for every source/destination pair
+# Returns list of dictionaries, one per pair
+def db_pair_status(conn):
+    write_log_entry(1, 'db_pair_status()')
+    sqlStmt = "SELECT b.source, b.destination, e.endDate, e.endTime, e.parsedResult, e.examinedFiles, e.sizeOfExaminedFiles, \
+        b.lastDate AS reportedDate, b.lastTime AS reportedTime FROM backupsets b LEFT JOIN \
+        (SELECT sourceComp, destComp, MAX(endDate || ' ' || endTime), endDate, endTime, parsedResult, examinedFiles, sizeOfExaminedFiles \
+        FROM emails GROUP BY sourceComp, destComp) e ON e.sourceComp = b.source AND e.destComp = b.destination \
+        ORDER BY b.source, b.destination"
+    dbCursor = exec_sqlite(conn, sqlStmt)
+    columns = [col[0] for col in dbCursor.description]
+    return [dict(zip(columns, row)) for row in dbCursor.fetchall()]
+
+# Backup history of a source/destination pair, oldest first, including yearly archives
+# since = 'YYYY/MM/DD'. Only return backups ending on or after this date. None = everything
+# Returns list of dictionaries, one per backup
+def db_pair_history(conn, opts, src, dest, since=None):
+    write_log_entry(1, 'db_pair_history({}, {}, {})'.format(src, dest, since))
+    sqlStmt = 'SELECT endDate, endTime, examinedFiles, sizeOfExaminedFiles, addedFiles, deletedFiles, modifiedFiles, \
+        filesWithError, parsedResult, warnings, errors, messages FROM {} WHERE sourceComp=? AND destComp=? AND endDate >= ? \
+        ORDER BY endDate, endTime'
+    rows = []
+    for tables in history_table_batches(conn, opts, history_years(opts, since)):
+        dbCursor = exec_sqlite(conn, sqlStmt.format(tables[0]), (src, dest, since if since is not None else ''))
+        columns = [col[0] for col in dbCursor.description]
+        rows.extend(dict(zip(columns, row)) for row in dbCursor.fetchall())
+    return rows
+
+# Cheap "has the database changed?" check for the status server
+# Every commit changes the -wal file (or the database file after a checkpoint), so comparing their size & modification
+# time catches commits from any process without running a query. Date is included because history ranges are relative to today.
+def db_signature(opts):
+    sig = [datetime.date.today()]
+    for fName in (opts['dbpath'], opts['dbpath'] + '-wal'):
+        try:
+            st = os.stat(fName)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:    # No -wal file when nobody has the database open
+            sig.append(None)
+    return tuple(sig)
+
+# Serve pair status as JSON on http://127.0.0.1:<port>/ until interrupted
+#   /status                                       - latest backup & last reported activity for every pair
+#   /history?source=S&destination=D[&days=N]      - backups for one pair over the last N days (default 30, at most maxDays)
+# Server is read-only and only listens on localhost. Responses are kept in memory and reused until
+# the database changes (see db_signature()), so dashboards can poll as often as they like.
+# Database errors fail just the request (HTTP 500). The server keeps running.
+def serve_status(conn, port, maxCache=1000, maxDays=36500):
+    write_log_entry(1, 'serve_status({})'.format(port))
+    import json
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+
+    cache = {}          # Request path -> JSON response
+    cacheSig = [None]   # Database signature the cache was built from
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            sig = db_signature(options)    # Get signature before querying, so a commit during the query empties the cache next time
+            if sig != cacheSig[0]:
+                write_log_entry(2, 'Database changed. Clearing {} cached responses'.format(len(cache)))
+                cache.clear()
+                cacheSig[0] = sig
+
+            body = cache.get(self.path)
+            if body is None:
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                try:
+                    if url.path == '/status':
+                        data = db_pair_status(conn)
+                    elif url.path == '/history':
+                        if ('source' not in query) or ('destination' not in query):
+                            self.send_error(400, 'source and destination are required')
+                            return
+                        try:
+                            days = int(query.get('days', ['30'])[0])
+                        except ValueError:
+                            self.send_error(400, 'days must be a number')
+                            return
+                        if days < 0:
+                            self.send_error(400, 'days can\'t be negative')
+                            return
+                        days = min(days, maxDays)
+                        since = (datetime.date.today() - datetime.timedelta(days=days)).strftime('%Y/%m/%d')
+                        data = db_pair_history(conn, options, query['source'][0], query['destination'][0], since)
+                    else:
+                        self.send_error(404)
+                        return
+                except sqlite3.Error as err:
+                    conn.rollback()
+                    self.send_error(500, 'Database error: {}'.format(err))
+                    return
+                body = json.dumps(data).encode('utf-8')
+                if len(cache) >= maxCache:    # Don't let odd queries grow the cache forever
+                    cache.clear()
+                cache[self.path] = body
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            write_log_entry(2, 'HTTP {} {}'.format(self.address_string(), format % args))
+
+    server = HTTPServer(('127.0.0.1', port), StatusHandler)
+    write_log_entry(1, 'Serving status on http://127.0.0.1:{}/status'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        write_log_entry(1, 'Status server stopped')
+    server.server_close()
+
 
 # Find all new emails on server
-def process_mailbox_pop(mBox):
+# Returns list of message numbers that are stored in the database
+def process_mailbox_pop(conn, mBox):
     write_log_entry(1,'process_mailbox_pop()')
 
+    storedMsgs = []
+
     # Open All Mail
     numMails = len(mBox.list()[1])
     write_log_entry(3,'POP3: numMails=[{}]'.format(numMails))
     for i in range(numMails):
         server_msg, body, octets = mBox.retr(i+1)
-        write_log_entry(3, 'server_msg=[{}]  body=[{}]  octets=[{}]'.format(server_msg,body,octets))
-        msg=''
-        for j in body:
-            msg = msg + '{}\n'.format(j.decode("utf-8"))
-        msg2 = email.message_from_string(msg)  # Get message body
-        write_log_entry(3, 'msg2=[{}]'.format(msg2))
-        mParts = process_message(msg2)
+        write_log_entry(3, 'server_msg=[{}]  octets=[{}]'.format(server_msg,octets))
+        mParts = process_message(conn, options, b'\r\n'.join(body))    # retr() returns message as list of lines
+        conn.commit()
+        if mParts != 1:    # New or already in database
+            storedMsgs.append(i+1)
 
-    return None
+    return storedMsgs
 
 
 # Find all new emails on server
-def process_mailbox_imap(mBox):
+# Returns list of UIDs of messages that are stored in the database
+def process_mailbox_imap(conn, mBox):
     # Open All Mail
     write_log_entry(1,'process_mailbox_imap()')
-    rv, data = mBox.search(None, "ALL")
+
+    storedMsgs = []
+
+    # Use UIDs rather than message sequence numbers so messages can be moved or deleted afterwards
+    rv, data = mBox.uid('SEARCH', None, "ALL")
     if rv != 'OK':
         write_log_entry(2, 'No messages found!')
-        return
+        return storedMsgs
 
     write_log_entry(3,'search data=[{}]'.format(data))
     # Loop through every emial in the mail box
-    # data[] contains all the record numbers in the mailbox.
+    # data[] contains all the message UIDs in the mailbox.
     # Loop through these to get all the existing messages
-    for num in data[0].split():
-        write_log_entry(3,'num=[{}]'.format(num))
-        rv, data = mBox.fetch(num,'(RFC822)') # Fetch message #num
-        write_log_entry(3,'rv=[{}] data=[{}]'.format(rv,data))
+    for uid in data[0].split():
+        write_log_entry(3,'uid=[{}]'.format(uid))
+        rv, data = mBox.uid('FETCH', uid, '(RFC822)') # Fetch message with UID
+        write_log_entry(3,'rv=[{}]'.format(rv))
         if rv != 'OK':
-            write_log_entry(1, 'ERROR getting message: {}'.format(num))
+            write_log_entry(1, 'ERROR getting message: {}'.format(uid))
+            break
+
+        mParts = process_message(conn, options, data[0][1])   # Process message into parts
+        conn.commit()
+        if mParts != 1:    # New or already in database
+            storedMsgs.append(uid)
+
+    return storedMsgs
+
+
+# Delete stored messages from POP3 server
+# Only call after the database transaction has been committed. Server removes the messages at quit()
+def postprocess_mailbox_pop(mBox, msgNums):
+    write_log_entry(1, 'postprocess_mailbox_pop()')
+
+    if options['inpostprocess'] == 'move':
+        write_log_entry(1, 'POP3 has no folders. postprocess=move ignored. Use postprocess=delete to remove messages.')
+        return
+    if options['inpostprocess'] != 'delete':
+        return
+
+    for num in msgNums:
+        rv = mBox.dele(num)
+        write_log_entry(3, 'POP3 dele({})=[{}]'.format(num, rv))
+    write_log_entry(1, 'Deleted {} messages from POP3 server'.format(len(msgNums)))
+
+
+# Move stored messages to archive folder or delete them from IMAP server
+# Only call after the database transaction has been committed.
+# UIDs are sent in batches of batchSize to keep command lines a reasonable length
+# Deleting (and moving without MOVE) needs UID EXPUNGE (UIDPLUS), so only our own messages are removed.
+# A plain EXPUNGE would also remove anything else flagged as deleted in the folder, so without UIDPLUS nothing is done.
+def postprocess_mailbox_imap(mBox, uids, batchSize=500):
+    write_log_entry(1, 'postprocess_mailbox_imap()')
+
+    if options['inpostprocess'] not in ('move', 'delete'):
+        return
+
+    # mBox.capabilities is what the server sent before login. Many servers (e.g., Gmail) only list MOVE & UIDPLUS
+    # once logged in, and imaplib doesn't refresh it, so ask again
+    rv, data = mBox.capability()
+    write_log_entry(3, 'IMAP CAPABILITY rv=[{}] data=[{}]'.format(rv, data))
+    if (rv == 'OK') and data and data[0]:
+        capabilities = data[0].decode('ascii', 'replace').upper().split()
+    else:
+        capabilities = mBox.capabilities
+
+    canMove = (options['inpostprocess'] == 'move') and ('MOVE' in capabilities)
+    if (not canMove) and ('UIDPLUS' not in capabilities):
+        write_log_entry(1, 'WARNING: IMAP server does not support UIDPLUS. Can\'t remove just the stored messages. postprocess={} skipped.'.format( \
+            options['inpostprocess']))
+        return
+
+    # Folder names with spaces need quoting
+    folder = options['inarchivefolder']
+    if ' ' in folder:
+        folder = '"{}"'.format(folder)
+
+    for i in range(0, len(uids), batchSize):
+        uidSet = b','.join(uids[i:i+batchSize])
+        write_log_entry(3, 'uidSet=[{}]'.format(uidSet))
+
+        if canMove:    # Server can do it in one step (RFC 6851)
+            rv, data = mBox.uid('MOVE', uidSet, folder)
+            write_log_entry(3, 'IMAP MOVE rv=[{}] data=[{}]'.format(rv, data))
+            if rv != 'OK':
+                write_log_entry(1, 'Could not move messages to folder {}: {}'.format(options['inarchivefolder'], data))
+                return
+            continue
+
+        if options['inpostprocess'] == 'move':    # No MOVE. COPY, then delete original
+            rv, data = mBox.uid('COPY', uidSet, folder)
+            write_log_entry(3, 'IMAP COPY rv=[{}] data=[{}]'.format(rv, data))
+            if rv != 'OK':
+                write_log_entry(1, 'Could not copy messages to folder {}: {}'.format(options['inarchivefolder'], data))
+                return
+
+        rv, data = mBox.uid('STORE', uidSet, '+FLAGS', '(\\Deleted)')
+        write_log_entry(3, 'IMAP STORE rv=[{}] data=[{}]'.format(rv, data))
+        if rv != 'OK':
+            write_log_entry(1, 'Could not flag messages for deletion: {}'.format(data))
+            return
+        rv, data = mBox.uid('EXPUNGE', uidSet)    # Only expunge our own messages (RFC 4315)
+        write_log_entry(3, 'IMAP EXPUNGE rv=[{}] data=[{}]'.format(rv, data))
+        if rv != 'OK':
+            write_log_entry(1, 'Could not expunge messages: {}'.format(data))
             return
 
-        write_log_entry(3,'data[0][1]=[{}]'.format(data[0][1]))
-        msg = email.message_from_string(data[0][1].decode('utf-8'))  # Get message body
-        write_log_entry(2, 'msg=[{}]'.format(msg))        
-        mParts = process_message(msg)                # Process message into parts
+    if options['inpostprocess'] == 'move':
+        write_log_entry(1, 'Moved {} messages to folder {}'.format(len(uids), options['inarchivefolder']))
+    else:
+        write_log_entry(1, 'Deleted {} messages from IMAP server'.format(len(uids)))
 
-    return None
+
+# Start CPU profiling for a program phase (--profile)
+# Returns profiler to pass to profile_stop(). None if not profiling.
+def profile_start(phase):
+    if options['profile'] != True:
+        return None
+    import cProfile
+
+    write_log_entry(2, 'profile_start({})'.format(phase))
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+# Stop CPU profiling for a program phase
+# Saves stats to <logfile>_<phase>.prof (readable with pstats or snakeviz) and writes top functions to log
+def profile_stop(profiler, phase):
+    if profiler is None:
+        return
+    import pstats
+    import io
+
+    profiler.disable()
+    statsPath = '{}_{}.prof'.format(os.path.splitext(options['logpath'])[0], phase)
+    profiler.dump_stats(statsPath)
+
+    statsText = io.StringIO()
+    pstats.Stats(profiler, stream=statsText).sort_stats('cumulative').print_stats(options['profiletop'])
+    write_log_entry(1, 'Profile for {} saved to {}. Top {} functions by cumulative time:\n{}'.format(phase, statsPath, \
+        options['profiletop'], statsText.getvalue()))
+
+# Start tracing memory allocations (--profilemem)
+# Returns snapshot to pass to memory_stop(). None if not tracing.
+def memory_start(label):
+    if options['profilemem'] != True:
+        return None
+    import tracemalloc
+
+    write_log_entry(2, 'memory_start({})'.format(label))
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    return tracemalloc.take_snapshot()
+
+# Stop tracing memory allocations. Writes peak memory use and top allocation sites since memory_start() to log
+def memory_stop(before, label):
+    if before is None:
+        return
+    import tracemalloc
+
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    ignoreTracemalloc = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    topStats = after.filter_traces(ignoreTracemalloc).compare_to(before.filter_traces(ignoreTracemalloc), 'lineno')
+    write_log_entry(1, 'Memory for {}: current={:,} bytes  peak={:,} bytes. Top {} allocation sites:\n{}'.format(label, \
+        current, peak, options['profiletop'], '\n'.join(str(stat) for stat in topStats[:options['profiletop']])))
 
 
 # Write a message to the log file
 def write_log_entry(level, entry):
-    # Logging levels (stored in options['verbose']):
+    # Logging levels (stored in logLevel, set from [main]verbose / -v):
     # 0 - No log info produced
     # 1 - Informational and program flow tracking
     # 2 - Additional state information
     # 3 - Full debug info
+    # Starts at 1 until the .rc file has been read. Logging is process-wide, shared by every DupReport object.
 
-    # Safety check in case verbose level has not yet been set.
-    # Most likely to occur at very beginning of program
-    # Much debate on whether this is really necessary :-)
-    if 'verbose' not in options:
-        options['verbose'] = 1
-
-    if level <= options['verbose']:  # Check that we're writing to an appropriate logging level
+    if level <= logLevel:  # Check that we're writing to an appropriate logging level
         if logFile is None:    # Log file not opened yet. Write to stderr
             sys.stderr.write(entry)
             sys.stderr.write('\n')
@@ -822,7 +1700,117 @@ def write_log_entry(level, entry):
             logFile.flush()
     return
 
-if __name__ == "__main__":
+# Library interface to dupReport
+# Keeps one database connection open for its whole life, so repeated calls reuse Sqlite's cached prepared statements.
+#
+#   with DupReport(rcPath='/etc/dupreport') as dr:
+#       dr.ingest_many(rawMessages)
+#       text, html = dr.build_report()
+#
+# rcPath & dbPath are directories, same as -r and -d on the command line. None = directory dupReport.py is in.
+# Other keyword arguments override .rc file options (e.g., verbose=2, sizereduce='mega')
+# Each object keeps its own options. Only the logging level (verbose) is shared by the whole process.
+# Problems are raised as DupReportError (configuration, locks) or sqlite3.Error (database)
+class DupReport:
+
+    def __init__(self, rcPath=None, dbPath=None, **overrides):
+        global logLevel
+        logLevel = overrides.get('verbose', 0)    # Stay quiet unless asked not to
+
+        argv = []
+        if rcPath is not None:
+            argv.extend(['-r', rcPath])
+        if dbPath is not None:
+            argv.extend(['-d', dbPath])
+        rcFile = '{}/{}'.format(rcPath if rcPath is not None else get_script_path(), rcName)
+        if rc_initialize(rcFile):
+            raise DupReportError('RC file {} initialized or changed. Please configure file before using it.'.format(rcFile))
+        self.options = {}
+        parse_config_file(rcFile, parse_command_line(argv), self.options)
+        self.options['verbose'] = logLevel
+        self.options.update(overrides)
+
+        needDbInit = os.path.isfile(self.options['dbpath']) is not True
+        self.conn = open_database(self.options)
+        if needDbInit:
+            db_initialize(self.conn)
+            self.conn.commit()
+        maj, min, subm, res = curr_db_version(self.conn)
+        if res == False:
+            self.conn.close()
+            raise DupReportError('Database version mismatch. {}.{}.{} required. Current version is {}.{}.{}.'.format(dbversion[0], \
+                dbversion[1], dbversion[2], maj, min, subm))
+        db_update_schema(self.conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    # Get run lock, same as the command line program's collection & report runs
+    def _run_lock(self, name):
+        lockFile = acquire_run_lock(self.options, name)
+        if lockFile is None:
+            raise DupReportError('Another dupReport {} run is in progress'.format(name))
+        return lockFile
+
+    # Store one raw email message (bytes)
+    # Returns True if the message was stored, False if it was already in the database or isn't a backup report
+    def ingest(self, message_bytes):
+        return self.ingest_many([message_bytes]) == 1
+
+    # Store raw email messages from any iterable in a single transaction
+    # Holds the collection lock, so it doesn't overlap a command line collection
+    # Returns number of messages stored
+    def ingest_many(self, messages):
+        lockFile = self._run_lock('collect')
+        try:
+            numStored = 0
+            for message_bytes in messages:
+                if isinstance(process_message(self.conn, self.options, message_bytes), dict):
+                    numStored += 1
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()    # Don't leave half a batch for the next commit
+            raise
+        finally:
+            release_run_lock(lockFile)
+        return numStored
+
+    # List of (source, destination) pairs known to the database
+    def pairs(self):
+        dbCursor = exec_sqlite(self.conn, 'SELECT source, destination FROM backupsets ORDER BY source, destination')
+        return dbCursor.fetchall()
+
+    # Backup history of a source/destination pair, oldest first, including yearly archives
+    # since = 'YYYY/MM/DD'. Only return backups ending on or after this date. None = everything
+    # Returns list of dictionaries, one per backup
+    def history(self, src, dest, since=None):
+        return db_pair_history(self.conn, self.options, src, dest, since)
+
+    # Build the summary report without sending it
+    # Like a normal report run, this moves each pair's "last reported" activity forward, so it holds the report lock
+    # Returns (text, html) of the main report
+    def build_report(self):
+        lockFile = self._run_lock('report')
+        try:
+            rows = create_summary_report(self.conn, self.options)
+        finally:
+            release_run_lock(lockFile)
+        return render_report(self.options, rows, self.options['summarysubject'], lambda pair: True)
+
+
+# Command line program
+def main():
+    global logFile, logLevel
+
     # Start Program Timer
     startTime = time.time()
 
@@ -844,23 +1832,28 @@ if __name__ == "__main__":
         needToExit=True  #Can't continue if RC gets initialized - need to editparameters
 
     # Get additional options from config file
-    parse_config_file(options['rcpath'], cmdLine)
+    parse_config_file(options['rcpath'], cmdLine, options)
+    logLevel = options['verbose']
 
     # Next, let's check if the DB exists or needs initializing
-    if ((os.path.isfile(options['dbpath']) is not True) or ('initdb' in options) or ('initdbrun' in options)):
+    # Need to check before opening, since connect() will create an empty database file
+    needDbInit = (os.path.isfile(options['dbpath']) is not True) or ('initdb' in options) or ('initdbrun' in options)
+
+    # Open SQLITE database. Same connection is used for the rest of the program
+    dbConn = open_database(options)
+
+    if needDbInit:
         # DB file doesn't exist or forced initialization
         write_log_entry(1, 'Database {} needs initializing.'.format(options['dbpath']))
-        dbConn = sqlite3.connect(options['dbpath'])
         db_initialize(dbConn)
         dbConn.commit()
-        dbConn.close()
         if 'initdbrun' not in options: # Flag to init and keep processing. If not there, exit program.
             write_log_entry(1, 'Database {} initialized. Exiting program.'.format(options['dbpath']))
             needToExit=True
         else:
             write_log_entry(1, 'Database {} initialized. -I = Continue processing.'.format(options['dbpath']))
 
-    maj, min, subm, res = curr_db_version()
+    maj, min, subm, res = curr_db_version(dbConn)
     if res == False:
         write_log_entry(1, 'Database version mismatch. {}.{}.{} required. Current version is {}.{}.{}.'.format(dbversion[0], dbversion[1], dbversion[2],
             maj, min, subm))
@@ -868,22 +1861,22 @@ if __name__ == "__main__":
         needToExit = True
 
     if needToExit:
+        dbConn.close()
         sys.exit(1)
 
     if cmdLine.version == True:   # Print version info & exit
-        version_info()
+        version_info(dbConn)
+        dbConn.close()
         sys.exit(0)
 
+    db_update_schema(dbConn)    # Add any newer tables & indexes to an existing database
+
     # Open log file
     if ('logappend' in options) and (options['logappend'] is True):
         logFile = open(options['logpath'],'a')
     else:
         logFile = open(options['logpath'],'w')
 
-    # Open SQLITE database
-    dbConn = sqlite3.connect(options['dbpath'])
-    dbCursor = dbConn.cursor()
-
     # Write startup information to log file
     write_log_entry(1,'******** dupReport Log - Start: {}'.format(time.asctime(time.localtime(time.time()))))
     write_log_entry(1,'Logfile=[{}]  appendlog=[{}]  logLevel=[{}]'.format(options['logpath'], options['logappend'], \
@@ -891,8 +1884,33 @@ if __name__ == "__main__":
     write_log_entry(2,'Config file options: {}'.format(options));
     write_log_entry(2,'dbPath={}  rcpath={}'.format(options['dbpath'], options['rcpath']))
     
-    if ('collect' in options) or ('report' not in options):
+    if 'export' in options:
+        # Export emails table & skip collection and report
+        export_emails(dbConn)
+
+    if 'rollover' in options:
+        # Move old emails to archive databases & skip collection and report
+        # Uses collection lock so nothing is adding emails at the same time
+        rolloverLock = acquire_run_lock(options, 'collect')
+        if rolloverLock is not None:
+            rollover_emails(dbConn, options)
+            release_run_lock(rolloverLock)
+
+    if 'serve' in options:
+        # Serve pair status over HTTP until interrupted & skip collection and report
+        serve_status(dbConn, options['serve'])
+
+    # Only one collection and one report may run against the same database at a time
+    singleOp = ('export' in options) or ('rollover' in options) or ('serve' in options)
+    runCollect = (not singleOp) and (('collect' in options) or ('report' not in options))
+    if runCollect:
+        collectLock = acquire_run_lock(options, 'collect')
+        runCollect = collectLock is not None
+
+    if runCollect:
+        profiler = profile_start('collect')
         if options['intransport'] == 'pop3':   # Incoming transport = POP3
+            import poplib
             write_log_entry(2,'Using POP3 incoming transport. Server={} Port={} Encryption={}'.format(options['inserver'], \
                 options['inport'],options['inencryption']))
             # Open incoming mailbox
@@ -906,16 +1924,21 @@ if __name__ == "__main__":
                 rv = mailBox.pass_(options['inpassword'])
                 write_log_entry(2,'POP3 password()=[{}]'.format(rv))
             except Exception as err:
-                write_log_entry(1,'Failed to connect to POP server: {}'.format(e.args))
+                write_log_entry(1,'Failed to connect to POP server: {}'.format(err.args))
                 sys.exit(1)
 
             rv, items, octets = mailBox.list()
             write_log_entry(3,'mailBox.list() rv=[{}]  items=[{}]  octets=[{}]'.format(rv,items,octets))
  
             write_log_entry(1, 'Processing POP3 mailbox...')
-            process_mailbox_pop(mailBox)
+            memSnapshot = memory_start('process_mailbox_pop()')
+            storedMsgs = process_mailbox_pop(dbConn, mailBox)
+            memory_stop(memSnapshot, 'process_mailbox_pop()')
+            dbConn.commit()    # Make sure messages are safely recorded before touching them on the server
+            postprocess_mailbox_pop(mailBox, storedMsgs)
             mailBox.quit()
         elif options['intransport'] == 'imap':   # Incoming transport = IMAP
+            import imaplib
             write_log_entry(1,'Using IMAP incoming transport. Server={} Port={} Encryption={}'.format(options['inserver'], \
                 options['inport'],options['inencryption']))
             if (options['inencryption'] == 'ssl') or (options['inencryption'] == 'tls'):
@@ -938,20 +1961,36 @@ if __name__ == "__main__":
             write_log_entry(3,'mailBox.select() rv=[{}] data=[{}]'.format(rv, data))
             if rv == 'OK':
                 write_log_entry(1, 'Processing IMAP mailbox...')
-                process_mailbox_imap(mailBox)
+                memSnapshot = memory_start('process_mailbox_imap()')
+                storedMsgs = process_mailbox_imap(dbConn, mailBox)
+                memory_stop(memSnapshot, 'process_mailbox_imap()')
+                dbConn.commit()    # Make sure messages are safely recorded before touching them on the server
+                postprocess_mailbox_imap(mailBox, storedMsgs)
             mailBox.logout()
         else:
             write_log_entry(1,'Unknown incoming transport: [{}]'.format(options['intransport']))
+        profile_stop(profiler, 'collect')
+        release_run_lock(collectLock)
+
+    runReport = (not singleOp) and (('report' in options) or ('collect' not in options))
+    if runReport:
+        reportLock = acquire_run_lock(options, 'report')
+        runReport = reportLock is not None
 
-    if ('report' in options) or ('collect' not in options):
+    if runReport:
+        profiler = profile_start('report')
         # All email has been collected. Create the report
-        create_summary_report()
+        memSnapshot = memory_start('create_summary_report()')
+        reportRows = create_summary_report(dbConn, options)
+        memory_stop(memSnapshot, 'create_summary_report()')
         # Calculate running time
         runningTime = 'Running Time: {:.3f} seconds.'.format(time.time() - startTime)
-        create_email_text((runningTime,),('',))
+        create_email_text(reportRows, (runningTime,),('',))
     
         # Send the report through email
-        send_email()
+        send_email(reportRows)
+        profile_stop(profiler, 'report')
+        release_run_lock(reportLock)
 
     dbConn.commit()    # Commit any remaining database transactions
     dbConn.close()     # Close database
@@ -963,3 +2002,14 @@ if __name__ == "__main__":
 
     # Bye, bye, bye, bye, bye!
     sys.exit(0)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except DupReportError as err:
+        sys.stderr.write('{}\n'.format(err))
+        sys.exit(1) # Abort program. Can't continue with RC error
+    except sqlite3.Error as err:
+        sys.stderr.write('SQLite error: {}\n'.format(err.args[0]))  # Write to stderr regardless of logging level
+        sys.exit(1) # Abort program. Can't continue with DB error
@@ -0,0 +1,85 @@
+#
+# Tests for anomaly detection (rolling window statistics, z-scores & growth)
+#
+# Run from the dupReport directory with: python3 -m unittest discover tests
+#
+
+import os
+import sys
+import random
+import sqlite3
+import datetime
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import dupReport
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'Anomaly detection needs NumPy')
+class DetectAnomaliesTest(unittest.TestCase):
+
+    def setUp(self):
+        dupReport.logLevel = 0
+        self.tempDir = tempfile.TemporaryDirectory()    # No archive databases in here
+        self.opts = {'dbpath': os.path.join(self.tempDir.name, 'dupReport.db'), 'anomalywindow': 3, 'anomalythreshold': 3.0,
+            'anomalyminstddev': 0.01, 'anomalygrowth': 50, 'anomalyhistory': 365}
+        self.conn = sqlite3.connect(':memory:')
+        dupReport.create_emails_table(self.conn, 'main')
+
+    def tearDown(self):
+        self.conn.close()
+        self.tempDir.cleanup()
+
+    # Store one run per day for a pair, oldest first, ending yesterday
+    def add_runs(self, src, sizes, fileCount=1000, modified=5):
+        today = datetime.date.today()
+        for i, size in enumerate(sizes):
+            endDate = (today - datetime.timedelta(days=len(sizes) - i)).strftime('%Y/%m/%d')
+            self.conn.execute("INSERT INTO emails (sourceComp, destComp, endDate, endTime, sizeOfExaminedFiles, examinedFiles, \
+                modifiedFiles, parsedResult) VALUES (?, 'dest', ?, '01:00:00', ?, ?, ?, 'Success')", (src, endDate, size, fileCount, modified))
+
+    def anomalies(self, src=None):
+        found = dupReport.detect_anomalies(self.conn, self.opts)
+        return {key[2]: notes for key, notes in found.items() if (src is None) or (key[0] == src)}
+
+    def test_known_values(self):
+        # Window [10, 20, 30]: mean 20, std dev sqrt(200/3) = 8.165, so 100 is +9.8 std devs. Growth from 10 is 900%
+        self.add_runs('src', [10, 20, 30, 100])
+        found = self.anomalies()
+        self.assertEqual(len(found), 1)
+        self.assertEqual(list(found.values())[0], ['Backup size up to 100 (+9.8 std devs from 3-run average of 20)',
+            'Backup size grew 900% over last 3 runs'])
+
+    def test_constant_history(self):
+        self.add_runs('src', [5000000000] * 20)
+        self.assertEqual(self.anomalies(), {})
+
+    def test_drop_after_constant_history(self):
+        self.add_runs('src', [5000000000] * 20 + [4500000000])
+        found = self.anomalies()
+        self.assertEqual(len(found), 1)
+        self.assertTrue(list(found.values())[0][0].startswith('Backup size down to 4,500,000,000'))
+
+    def test_zero_size_base(self):
+        # No growth percentage can be worked out from a size of 0
+        self.add_runs('src', [0, 100, 100, 100, 100])
+        self.assertEqual(self.anomalies(), {})
+
+    def test_pairs_independent(self):
+        self.opts['anomalywindow'] = 10
+        noise = random.Random(7)
+        self.add_runs('steady', [5000000000 + noise.gauss(0, 2000000) for i in range(200)])    # Steady pair, pure noise
+        alone = self.anomalies('steady')
+
+        self.add_runs('big', [1e15 * 1.05 ** i for i in range(200)])    # Large, fast-growing pair. Sorts before 'steady'
+        self.assertEqual(self.anomalies('steady'), alone)
+
+
+if __name__ == '__main__':
+    unittest.main()
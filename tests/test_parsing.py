@@ -0,0 +1,98 @@
+#
+# Tests for subject parsing and date conversion
+#
+# Run from the dupReport directory with: python3 -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import dupReport
+
+# Default subject & source/destination patterns from the .rc file
+subjectRegex = '^Duplicati Backup report for'
+srcRegex = '\\w*'
+destRegex = '\\w*'
+delimiter = '-'
+
+
+class ConvertDateTimeTest(unittest.TestCase):
+
+    def setUp(self):
+        dupReport.logLevel = 0
+        dupReport.convert_date_time.cache_clear()
+
+    def test_12_hour(self):
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 1:05:01 PM', 'MDY'), ('2018/06/13', '13:05:01'))
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 9:05:01 AM', 'MDY'), ('2018/06/13', '09:05:01'))
+
+    def test_12_am_pm(self):
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 12:00:00 AM', 'MDY'), ('2018/06/13', '00:00:00'))
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 12:30:00 PM', 'MDY'), ('2018/06/13', '12:30:00'))
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 12:30:00 a.m.', 'MDY'), ('2018/06/13', '00:30:00'))
+
+    def test_24_hour(self):
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 23:59:58', 'MDY'), ('2018/06/13', '23:59:58'))
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 00:10', 'MDY'), ('2018/06/13', '00:10:00'))
+        self.assertEqual(dupReport.convert_date_time('6/13/2018 07:08:09.123', 'MDY'), ('2018/06/13', '07:08:09'))
+
+    def test_mdy(self):
+        self.assertEqual(dupReport.convert_date_time('05/06/2018 10:00:00', 'MDY')[0], '2018/05/06')
+        self.assertEqual(dupReport.convert_date_time('12/31/2018 10:00:00', 'MDY')[0], '2018/12/31')
+
+    def test_dmy(self):
+        # Day <= 12 must still be read as the day. Order comes from the format, not the values
+        self.assertEqual(dupReport.convert_date_time('05/06/2018 10:00:00', 'DMY')[0], '2018/06/05')
+        self.assertEqual(dupReport.convert_date_time('13/06/2018 10:00:00', 'DMY')[0], '2018/06/13')
+        self.assertEqual(dupReport.convert_date_time('05.06.2018 10:00:00', 'DMY')[0], '2018/06/05')
+
+    def test_ymd(self):
+        self.assertEqual(dupReport.convert_date_time('2018-06-05 10:00:00', 'YMD')[0], '2018/06/05')
+        self.assertEqual(dupReport.convert_date_time('2018/06/05 10:00:00', 'YMD')[0], '2018/06/05')
+
+    def test_wrong_format(self):
+        with self.assertRaises(ValueError):
+            dupReport.convert_date_time('13/06/2018 10:00:00', 'MDY')
+        with self.assertRaises(ValueError):
+            dupReport.convert_date_time('2018-06-05 10:00:00', 'DMY')
+        with self.assertRaises(ValueError):
+            dupReport.convert_date_time('06/2018 10:00:00', 'MDY')
+
+    def test_empty(self):
+        self.assertIsNone(dupReport.convert_date_time('', 'MDY'))
+
+    def test_cache_key_includes_format(self):
+        self.assertEqual(dupReport.convert_date_time('05/06/2018 10:00:00', 'MDY')[0], '2018/05/06')
+        self.assertEqual(dupReport.convert_date_time('05/06/2018 10:00:00', 'DMY')[0], '2018/06/05')
+        self.assertEqual(dupReport.convert_date_time('05/06/2018 10:00:00', 'MDY')[0], '2018/05/06')
+        self.assertEqual(dupReport.convert_date_time.cache_info().hits, 1)
+
+
+class ParseSubjectTest(unittest.TestCase):
+
+    def setUp(self):
+        dupReport.logLevel = 0
+        dupReport.parse_subject.cache_clear()
+
+    def parse(self, subject):
+        return dupReport.parse_subject(subject, subjectRegex, srcRegex, destRegex, delimiter)
+
+    def test_source_destination(self):
+        self.assertEqual(self.parse('Duplicati Backup report for Fred_Home-Homers_Minio'), ('Fred_Home', 'Homers_Minio'))
+
+    def test_not_of_interest(self):
+        self.assertIsNone(self.parse('Lunch on Friday?'))
+
+    def test_no_delimiter(self):
+        self.assertEqual(self.parse('Duplicati Backup report for FredHome'), (None, None))
+
+    def test_cached(self):
+        self.parse('Duplicati Backup report for Fred-Minio')
+        self.parse('Duplicati Backup report for Fred-Minio')
+        self.assertEqual(dupReport.parse_subject.cache_info().hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()